@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+"""
+Run this script in the contrib folder with the same python version as TerrariumPI
+
+./benchmark.py
+./benchmark.py --sensors 20 --relays 10 --days 730 --rounds 10
+./benchmark.py --database /tmp/benchmark.db --json before.json
+./benchmark.py --database /tmp/benchmark.db --compare before.json
+
+It will create a database with all the migrations applied, and fills it with synthetic history: sensors with a day and night
+pattern for every minute, and relays that toggle like lights, heaters, misting systems and dimmers. Then it times the most
+used API and engine calls against that database. An existing database is reused, so the same data can be used before and after a change.
+The script does not need any hardware or a running TerrariumPI. Run this after changing the history queries or database migrations.
+"""
+
+import argparse
+import gettext
+import json
+import math
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+from yoyo import get_backend, read_migrations
+
+ROOT = Path(__file__).resolve().parent.parent
+MIGRATIONS = ROOT / "migrations"
+
+# Average value, day/night swing, limit min/max and alarm min/max per sensor type
+SENSOR_TYPES = {
+    "temperature": (26.0, 4.0, 0.0, 50.0, 22.0, 30.0),
+    "humidity": (70.0, 15.0, 0.0, 100.0, 55.0, 90.0),
+    "moisture": (45.0, 5.0, 0.0, 100.0, 30.0, 60.0),
+    "light": (40.0, 40.0, 0.0, 100.0, 0.0, 100.0),
+}
+
+# Relay patterns with the wattage and water flow
+RELAY_TYPES = {
+    "lights": (60.0, 0.0),
+    "heater": (100.0, 0.0),
+    "misting": (15.0, 0.4),
+    "dimmer": (40.0, 0.0),
+}
+
+# The engine stores the relay state every 15 minutes, next to the changes
+RELAY_FORCED_UPDATE = timedelta(minutes=15)
+
+# The relay totals are calculated by migration 0004 for the existing history, and kept up to date when the history is stored
+RELAY_USAGE = MIGRATIONS / "0004_create_relayusage.sql"
+
+SENSOR_ROLLUPS = [
+    """
+INSERT OR REPLACE INTO "SensorHistoryHourly"
+  SELECT "sh"."sensor", strftime('%Y-%m-%d %H:00:00', "sh"."timestamp"), AVG("sh"."value"), MIN("sh"."value"), MAX("sh"."value"), AVG("sl"."limit_min"), AVG("sl"."limit_max"), AVG("sl"."alarm_min"), AVG("sl"."alarm_max"), MAX("sl"."exclude_avg"), COUNT(*)
+  FROM "SensorHistory" AS "sh" JOIN "SensorHistoryLimits" AS "sl" ON "sl"."sensor" = "sh"."sensor" AND "sl"."timestamp" = (
+    SELECT MAX("timestamp") FROM "SensorHistoryLimits" WHERE "sensor" = "sh"."sensor" AND "timestamp" <= "sh"."timestamp"
+  )
+  GROUP BY "sh"."sensor", strftime('%Y-%m-%d %H:00:00', "sh"."timestamp")""",
+    """
+INSERT OR REPLACE INTO "SensorHistoryDaily"
+  SELECT "sensor", strftime('%Y-%m-%d 00:00:00', "timestamp"), SUM("value" * "samples") / SUM("samples"), MIN("value_min"), MAX("value_max"), SUM("limit_min" * "samples") / SUM("samples"), SUM("limit_max" * "samples") / SUM("samples"), SUM("alarm_min" * "samples") / SUM("samples"), SUM("alarm_max" * "samples") / SUM("samples"), MAX("exclude_avg"), SUM("samples")
+  FROM "SensorHistoryHourly"
+  GROUP BY "sensor", strftime('%Y-%m-%d 00:00:00', "timestamp")""",
+]
+
+
+def create_database(database):
+    # The auto vacuum mode can only be set before the first table is created
+    with sqlite3.connect(database) as db:
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+    backend = get_backend(f"sqlite:///{database}")
+    with backend.lock():
+        backend.apply_migrations(backend.to_apply(read_migrations(str(MIGRATIONS))))
+
+
+def sensor_history(sensor_type, start, end, randomizer):
+    average, swing = SENSOR_TYPES[sensor_type][:2]
+    timestamp = start
+    value = average
+    while timestamp < end:
+        # About 1 in 200 readings fails, and is missing in the history
+        if randomizer.random() >= 0.005:
+            day_part = (timestamp.hour * 60 + timestamp.minute) / 1440.0
+            # Slowly follow the day and night curve, with some sensor noise
+            value += ((average + swing * math.sin(2 * math.pi * (day_part - 0.25))) - value) * 0.1
+            value += randomizer.gauss(0, swing / 50.0)
+            yield f"{timestamp:%Y-%m-%d %H:%M:%S.%f}", round(value, 2), randomizer.randint(1, 2)
+
+        timestamp += timedelta(minutes=1)
+
+
+def relay_changes(relay_type, start, end, randomizer):
+    # Yields the moments the relay changes its state
+    day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    heater = (start, 0.0)
+    while day < end:
+        if "lights" == relay_type:
+            yield day + timedelta(hours=8), 100.0
+            yield day + timedelta(hours=20), 0.0
+
+        elif "dimmer" == relay_type:
+            # Sunrise and sunset in 10 steps
+            for step in range(1, 11):
+                yield day + timedelta(hours=7, minutes=step * 6), step * 10.0
+                yield day + timedelta(hours=20, minutes=step * 6), 100.0 - step * 10.0
+
+        elif "misting" == relay_type:
+            for hour in [9, 12, 15, 18]:
+                moment = day + timedelta(hours=hour, seconds=randomizer.randint(0, 120))
+                yield moment, 100.0
+                yield moment + timedelta(seconds=randomizer.randint(30, 90)), 0.0
+
+        elif "heater" == relay_type:
+            # Thermostat like toggling, more on time during the night
+            while heater[0] < day + timedelta(days=1):
+                night = heater[0].hour < 8 or heater[0].hour >= 20
+                on = 0.0 == heater[1]
+                minutes = randomizer.randint(20, 45) if on == night else randomizer.randint(5, 20)
+                heater = (
+                    heater[0] + timedelta(minutes=minutes, seconds=randomizer.randint(0, 59)),
+                    100.0 if on else 0.0,
+                )
+                yield heater
+
+        day += timedelta(days=1)
+
+
+def relay_history(relay_type, start, end, randomizer):
+    changes = [change for change in relay_changes(relay_type, start, end, randomizer) if start <= change[0] < end]
+    changes.sort()
+
+    value = 0.0
+    forced = start
+    for timestamp, new_value in changes + [(end, None)]:
+        # The forced updates between the changes
+        while forced < timestamp:
+            yield forced, value
+            forced += RELAY_FORCED_UPDATE
+
+        if new_value is not None and new_value != value:
+            value = new_value
+            # The relay changes a bit after the engine loop started
+            yield timestamp + timedelta(microseconds=randomizer.randint(0, 999999)), value
+
+
+def fill_database(database, sensors, relays, days, seed):
+    randomizer = random.Random(seed)
+    end = datetime.now().replace(second=0, microsecond=0)
+    start = end - timedelta(days=days)
+
+    print(f"Generating {days} days of history for {sensors} sensors and {relays} relays. This can take a while...")
+    generation = time.time()
+    with sqlite3.connect(database) as db:
+        sensor_types = list(SENSOR_TYPES.keys())
+        sensor_ids = []
+        for nr in range(sensors):
+            sensor_type = sensor_types[nr % len(sensor_types)]
+            average, swing, limit_min, limit_max, alarm_min, alarm_max = SENSOR_TYPES[sensor_type]
+            sensor_id = f"benchmark-sensor-{nr:03}"
+            sensor_ids.append(sensor_id)
+
+            db.execute(
+                'INSERT INTO "Sensor" ("id", "hardware", "type", "name", "address", "limit_min", "limit_max", "alarm_min", "alarm_max", "max_diff", "exclude_avg", "calibration") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    sensor_id,
+                    "benchmark",
+                    sensor_type,
+                    f"Benchmark {sensor_type} {nr}",
+                    str(nr),
+                    limit_min,
+                    limit_max,
+                    alarm_min,
+                    alarm_max,
+                    0.0,
+                    nr % 5 == 4,
+                    "{}",
+                ),
+            )
+
+            # The alarm values are changed about once a month
+            limits = start
+            while limits < end:
+                shift = randomizer.uniform(-1, 1)
+                db.execute(
+                    'INSERT INTO "SensorHistoryLimits" VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        sensor_id,
+                        f"{limits:%Y-%m-%d %H:%M:%S.%f}",
+                        limit_min,
+                        limit_max,
+                        alarm_min + shift,
+                        alarm_max + shift,
+                        nr % 5 == 4,
+                    ),
+                )
+                limits += timedelta(days=randomizer.randint(20, 40), minutes=randomizer.randint(0, 1439))
+
+            db.executemany(
+                'INSERT INTO "SensorHistory" ("sensor", "timestamp", "value", "samples") VALUES (?, ?, ?, ?)',
+                ((sensor_id, *row) for row in sensor_history(sensor_type, start, end, randomizer)),
+            )
+            db.commit()
+            print(f"  Sensor {nr + 1}/{sensors} ({sensor_type}) done")
+
+        for query in SENSOR_ROLLUPS:
+            db.execute(query)
+
+        relay_types = list(RELAY_TYPES.keys())
+        relay_ids = []
+        for nr in range(relays):
+            relay_type = relay_types[nr % len(relay_types)]
+            wattage, flow = RELAY_TYPES[relay_type]
+            relay_id = f"benchmark-relay-{nr:03}"
+            relay_ids.append(relay_id)
+
+            db.execute(
+                'INSERT INTO "Relay" ("id", "hardware", "name", "address", "wattage", "flow", "manual_mode", "replacement", "calibration") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    relay_id,
+                    "benchmark" if "dimmer" != relay_type else "benchmark-dimmer",
+                    f"Benchmark {relay_type} {nr}",
+                    str(nr),
+                    wattage,
+                    flow,
+                    False,
+                    f"{start:%Y-%m-%d %H:%M:%S.%f}",
+                    "{}",
+                ),
+            )
+            db.executemany(
+                'INSERT OR IGNORE INTO "RelayHistory" ("relay", "timestamp", "value", "wattage", "flow") VALUES (?, ?, ?, ?, ?)',
+                (
+                    (
+                        relay_id,
+                        f"{timestamp:%Y-%m-%d %H:%M:%S.%f}",
+                        value,
+                        value / 100.0 * wattage,
+                        value / 100.0 * flow,
+                    )
+                    for timestamp, value in relay_history(relay_type, start, end, randomizer)
+                ),
+            )
+            db.commit()
+            print(f"  Relay {nr + 1}/{relays} ({relay_type}) done")
+
+        db.executescript(RELAY_USAGE.read_text())
+
+        # Two enclosures with a door and areas that are using the generated sensors and relays
+        for nr in range(2):
+            enclosure_id = f"benchmark-enclosure-{nr}"
+            db.execute(
+                'INSERT INTO "Enclosure" ("id", "name", "image", "description") VALUES (?, ?, ?, ?)',
+                (enclosure_id, f"Benchmark enclosure {nr}", "", "Generated by the benchmark script"),
+            )
+            button_id = f"benchmark-door-{nr}"
+            db.execute(
+                'INSERT INTO "Button" ("id", "hardware", "name", "address", "calibration", "enclosure") VALUES (?, ?, ?, ?, ?, ?)',
+                (button_id, "benchmark", f"Benchmark door {nr}", str(nr), "{}", enclosure_id),
+            )
+            db.executemany(
+                'INSERT OR IGNORE INTO "ButtonHistory" ("button", "timestamp", "value") VALUES (?, ?, ?)',
+                (
+                    (
+                        button_id,
+                        f"{start + timedelta(days=day, hours=hour, seconds=second):%Y-%m-%d %H:%M:%S.%f}",
+                        value,
+                    )
+                    for day in range(days)
+                    for hour, second, value in [(10, 0, 1.0), (10, 45, 0.0), (18, 0, 1.0), (18, 30, 0.0)]
+                ),
+            )
+
+            for area_nr, area_type in enumerate(["lights", "temperature", "humidity"]):
+                setup = {
+                    "main_lights": "lights" == area_type,
+                    "sensors": sensor_ids[nr::2][:3],
+                    "day": {"relays": relay_ids[nr::2][:2], "begin": "08:00", "end": "20:00"},
+                    "night": {"relays": relay_ids[nr::2][2:4], "begin": "20:00", "end": "08:00"},
+                    "low": {"relays": relay_ids[nr::2][:1], "delay_on": 0, "delay_off": 0},
+                    "high": {"relays": relay_ids[nr::2][1:2], "delay_on": 0, "delay_off": 0},
+                }
+                db.execute(
+                    'INSERT INTO "Area" ("id", "enclosure", "name", "type", "mode", "setup", "state") VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        f"benchmark-area-{nr}-{area_nr}",
+                        enclosure_id,
+                        f"Benchmark {area_type} {nr}",
+                        area_type,
+                        "weather" if "lights" == area_type else "sensors",
+                        json.dumps(setup),
+                        json.dumps({"is_day": True, "powered": False}),
+                    ),
+                )
+
+        db.commit()
+        db.execute("PRAGMA optimize")
+
+    print(f"Generated the database in {time.time() - generation:.2f} seconds\n")
+
+
+def load_terrariumpi(database, partitions):
+    # The modules expect to run from the root folder of TerrariumPI
+    os.chdir(ROOT)
+    sys.path.insert(0, str(ROOT))
+    gettext.install("terrariumpi", "locales/")
+
+    # Load the logging first like terrariumPI.py does, as the database and the notifications import each other
+    import terrariumLogging
+    import terrariumDatabase
+
+    terrariumDatabase.DATABASE = database
+    terrariumDatabase.HISTORY_PARTITIONS = partitions
+    terrariumDatabase.init("benchmark")
+
+    from terrariumAPI import terrariumAPI
+    from terrariumEngine import terrariumEngine
+
+    # Only the parts of the engine and webserver that are used by the benchmarked calls
+    engine = SimpleNamespace(settings={"exclude_ids": []}, units=defaultdict(str))
+    api = terrariumAPI(SimpleNamespace(engine=engine))
+
+    return terrariumDatabase, api, terrariumEngine, engine
+
+
+def call(api, func, *args, query=""):
+    from bottle import request, response
+
+    request.bind({"REQUEST_METHOD": "GET", "PATH_INFO": "/benchmark/", "QUERY_STRING": query})
+    response.bind()
+    data = func(*args)
+
+    # Include the serialization and streaming of the result, like the webserver does
+    if isinstance(data, dict):
+        return len(json.dumps(data))
+    if isinstance(data, bytes):
+        return len(data)
+
+    return sum(len(chunk) for chunk in data)
+
+
+def benchmarks(terrariumDatabase, api, terrariumEngine, engine):
+    from pony import orm
+
+    with orm.db_session():
+        sensors = list(orm.select((sensor.id, sensor.type) for sensor in terrariumDatabase.Sensor).order_by(1))
+        relays = list(orm.select(relay.id for relay in terrariumDatabase.Relay).order_by(1))
+        enclosures = list(orm.select(enclosure.id for enclosure in terrariumDatabase.Enclosure).order_by(1))
+
+    tests = {}
+    # A single sensor, all sensors of a type and a selection of sensors
+    filters = {"sensor": sensors[0][0], "type": sensors[0][1], "selection": [sensor for sensor, _ in sensors[:3]]}
+    for name, sensor_filter in filters.items():
+        for period in ["day", "week", "month", "year"]:
+            tests[f"sensor_history[{name}-{period}]"] = lambda sensor_filter=sensor_filter, period=period: call(
+                api, api.sensor_history, sensor_filter, "history", period
+            )
+
+    # Polling for the new values of the graphs
+    for period in ["day", "week", "month", "year"]:
+        tests[f"sensor_history[since-{period}]"] = lambda period=period: call(
+            api,
+            api.sensor_history,
+            sensors[0][0],
+            "history",
+            period,
+            query=f"since={(datetime.now() - timedelta(minutes=5)).timestamp()}",
+        )
+
+    for period in ["day", "week", "month"]:
+        tests[f"relay_history[{period}]"] = lambda period=period: call(
+            api, api.relay_history, relays[0], "history", period
+        )
+
+    for period in ["week", "month", "year"]:
+        tests[f"sensor_export[{period}]"] = lambda period=period: call(
+            api, api.sensor_history, sensors[0][0], "export", period
+        )
+        tests[f"relay_export[{period}]"] = lambda period=period: call(
+            api, api.relay_history, relays[0], "export", period
+        )
+
+    tests["sensor_history[columns-max_points]"] = lambda: call(
+        api, api.sensor_history, sensors[0][0], "history", "week", query="format=columns&max_points=500"
+    )
+
+    def sensor_to_dict():
+        # Without the latest values cache, like after a restart
+        terrariumDatabase.latest_values.clear()
+        with orm.db_session():
+            return len([sensor.to_dict() for sensor in terrariumDatabase.Sensor.select()])
+
+    tests["Sensor.to_dict[cold]"] = sensor_to_dict
+    tests["sensor_averages"] = lambda: terrariumEngine.sensor_averages.fget(engine)
+    tests["total_power_and_water_usage"] = lambda: terrariumEngine.total_power_and_water_usage.fget(engine)
+    tests["enclosure_detail"] = lambda: [call(api, api.enclosure_detail, enclosure) for enclosure in enclosures]
+
+    return tests
+
+
+def run(tests, rounds, selection=None):
+    results = {}
+    for name, test in tests.items():
+        if selection is not None and selection not in name:
+            continue
+
+        # Warm up the caches of SQLite and Pony first
+        test()
+        timings = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            test()
+            timings.append(time.perf_counter() - start)
+
+        results[name] = {
+            "min": min(timings),
+            "max": max(timings),
+            "mean": statistics.mean(timings),
+            "stddev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+            "median": statistics.median(timings),
+            "rounds": rounds,
+        }
+
+    return results
+
+
+def report(results, previous=None):
+    width = max(len(name) for name in results) + 2
+    header = f"{'Name (time in ms)':{width}}{'Min':>12}{'Max':>12}{'Mean':>12}{'StdDev':>12}{'Median':>12}{'Rounds':>8}"
+    if previous is not None:
+        header += f"{'Change':>10}"
+
+    print(header)
+    print("-" * len(header))
+    for name, stats in results.items():
+        line = f"{name:{width}}"
+        for field in ["min", "max", "mean", "stddev", "median"]:
+            line += f"{stats[field] * 1000:12.2f}"
+
+        line += f"{stats['rounds']:8}"
+        if previous is not None:
+            if name in previous:
+                line += f"{(stats['median'] / previous[name]['median'] - 1) * 100:+9.1f}%"
+            else:
+                line += f"{'new':>10}"
+
+        print(line)
+
+
+def history_sizes(database):
+    # Table and index sizes together, as an index can cost as much space as the compacted table itself
+    with sqlite3.connect(database) as db:
+        rows = db.execute("""SELECT "schema"."tbl_name",
+                 TOTAL(CASE WHEN "schema"."type" = 'table' THEN "dbstat"."pgsize" END),
+                 TOTAL(CASE WHEN "schema"."type" = 'index' THEN "dbstat"."pgsize" END)
+               FROM "dbstat" JOIN "sqlite_schema" AS "schema" ON "schema"."name" = "dbstat"."name"
+               WHERE "schema"."tbl_name" LIKE '%History%' OR "schema"."tbl_name" = 'RelayUsage'
+               GROUP BY "schema"."tbl_name"
+               ORDER BY "schema"."tbl_name\"""").fetchall()
+
+    return {table: {"table": int(table_size), "indexes": int(index_size)} for table, table_size, index_size in rows}
+
+
+def report_sizes(sizes):
+    width = max(len(name) for name in sizes) + 2
+    header = f"{'Name (size in MB)':{width}}{'Table':>12}{'Indexes':>12}{'Total':>12}"
+    print(header)
+    print("-" * len(header))
+    for name, size in sizes.items():
+        print(
+            f"{name:{width}}{size['table'] / 1e6:12.2f}{size['indexes'] / 1e6:12.2f}{(size['table'] + size['indexes']) / 1e6:12.2f}"
+        )
+
+    print()
+
+
+parser = argparse.ArgumentParser(description="Benchmark the TerrariumPI history queries against a synthetic database")
+parser.add_argument("--database", help="database file to use. It is generated when it does not exist")
+parser.add_argument("--sensors", type=int, default=8, help="amount of sensors to generate (default: 8)")
+parser.add_argument("--relays", type=int, default=8, help="amount of relays to generate (default: 8)")
+parser.add_argument("--days", type=int, default=365, help="days of history to generate (default: 365)")
+parser.add_argument("--seed", type=int, default=42, help="seed for the random generator (default: 42)")
+parser.add_argument("--rounds", type=int, default=5, help="rounds per benchmark (default: 5)")
+parser.add_argument("--select", help="only run the benchmarks that contain this text")
+parser.add_argument("--json", help="save the results as json to this file")
+parser.add_argument("--compare", help="compare the median timings with an earlier json file")
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as folder:
+    database = str(Path(args.database).resolve()) if args.database else f"{folder}/terrariumpi.db"
+    if not Path(database).exists():
+        create_database(database)
+        fill_database(database, args.sensors, args.relays, args.days, args.seed)
+
+    sizes = history_sizes(database)
+    report_sizes(sizes)
+
+    previous = None
+    if args.compare:
+        previous = json.loads(Path(args.compare).read_text())["benchmarks"]
+
+    # Loading TerrariumPI will change the working folder
+    output = Path(args.json).resolve() if args.json else None
+    results = run(benchmarks(*load_terrariumpi(database, f"{folder}/history")), args.rounds, args.select)
+    report(results, previous)
+
+    if output is not None:
+        output.write_text(
+            json.dumps(
+                {"datetime": datetime.now().isoformat(), "database": database, "sizes": sizes, "benchmarks": results},
+                indent=2,
+            )
+        )
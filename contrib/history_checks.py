@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+ Run this script in the contrib folder with the same python version as TerrariumPI
+
+ ./history_checks.py
+
+ It will create an empty database with all the migrations applied, and fills it with a short sensor history. Then it checks
+ that the sensor history API returns the first bucket of a period that starts exactly on an hour or a day, and that polling
+ with the since parameter returns the last bucket again at every resolution. The script will exit with an error when a check fails.
+ Run this after changing the history queries, the rollups or the timestamp format of the history.
+"""
+
+import gettext
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# The sensors that are stored, and the filters of the sensor history API
+SENSORS = {"check-sensor-1": "temperature", "check-sensor-2": "temperature"}
+FILTERS = {"sensor": "check-sensor-1", "type": "temperature", "selection": list(SENSORS.keys())}
+
+# The length of the period selects the resolution of the sensor history
+RESOLUTIONS = {"minute": timedelta(hours=12), "hour": timedelta(days=10), "day": timedelta(days=200)}
+
+
+def load_terrariumpi(database, partitions):
+    # The modules expect to run from the root folder of TerrariumPI
+    os.chdir(ROOT)
+    sys.path.insert(0, str(ROOT))
+    gettext.install("terrariumpi", "locales/")
+
+    # Load the logging first like terrariumPI.py does, as the database and the notifications import each other
+    import terrariumLogging
+    import terrariumDatabase
+
+    terrariumDatabase.DATABASE = database
+    terrariumDatabase.HISTORY_PARTITIONS = partitions
+    terrariumDatabase.init("history_checks")
+
+    from terrariumAPI import terrariumAPI
+
+    # Only the parts of the engine and webserver that are used by the sensor history
+    engine = SimpleNamespace(settings={"exclude_ids": []})
+    return terrariumDatabase, terrariumAPI(SimpleNamespace(engine=engine))
+
+
+def store_history(terrariumDatabase, start, end):
+    from pony import orm
+
+    with orm.db_session():
+        for sensor, sensor_type in SENSORS.items():
+            terrariumDatabase.Sensor(id=sensor, hardware="check", type=sensor_type, name=sensor, address="check")
+
+        timestamp = start
+        while timestamp < end:
+            for nr, sensor in enumerate(SENSORS):
+                terrariumDatabase.SensorHistory.merge(sensor, timestamp, 20.0 + nr, 0.0, 50.0, 10.0, 40.0, False)
+
+            timestamp += timedelta(minutes=30)
+
+        terrariumDatabase.SensorHistory.update_rollups()
+
+
+def sensor_history(api, sensor_filter, **parameters):
+    from bottle import request, response
+
+    query = "&".join(f"{key}={value.timestamp()}" for key, value in parameters.items())
+    request.bind({"REQUEST_METHOD": "GET", "PATH_INFO": "/history_checks/", "QUERY_STRING": query})
+    response.bind()
+
+    return [datetime.fromtimestamp(point["timestamp"]) for point in api.sensor_history(sensor_filter)["data"]]
+
+
+def run_checks(api, now):
+    failed = []
+    for resolution, length in RESOLUTIONS.items():
+        # A period that starts exactly at midnight, which is the start of a bucket at every resolution
+        start = (now - length).replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + length
+
+        for name, sensor_filter in FILTERS.items():
+            checks = {}
+
+            points = sensor_history(api, sensor_filter, start=start, end=end)
+            checks["aligned start"] = len(points) > 0 and points[0] == start
+
+            if len(points) > 0:
+                # The last bucket is still updated, so the rollups return it again. The minute history only returns newer points
+                since = sensor_history(api, sensor_filter, start=start, end=end, since=points[-1])
+                checks["since"] = since == ([] if "minute" == resolution else points[-1:])
+
+                since = sensor_history(api, sensor_filter, start=start, end=end, since=points[-2])
+                checks["since previous"] = since == points[-1:] if "minute" == resolution else since == points[-2:]
+
+            for check in ["aligned start", "since", "since previous"]:
+                result = checks.get(check, False)
+                print(f"{'OK' if result else 'FAIL':4} {resolution:6} {name:9} {check}")
+                if not result:
+                    failed.append(f"{resolution} {name} {check}")
+
+    return failed
+
+
+with tempfile.TemporaryDirectory() as folder:
+    terrariumDatabase, api = load_terrariumpi(f"{folder}/terrariumpi.db", f"{folder}/history")
+    now = datetime.now().replace(minute=0, second=0, microsecond=0)
+    store_history(terrariumDatabase, now - max(RESOLUTIONS.values()) - timedelta(days=2), now)
+    failed = run_checks(api, now)
+
+if failed:
+    print(f"\n{len(failed)} checks failed: {', '.join(failed)}")
+    sys.exit(1)
+
+print("\nAll history boundary checks passed")
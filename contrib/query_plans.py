@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Run this script in the contrib folder with the same python version as TerrariumPI
+
+./query_plans.py
+
+It will create an empty database with all the migrations applied, and runs the history functions of TerrariumPI on a
+small history. The SQL of every history query is captured from the database connections, also the queries that Pony
+generates, and the query plans are checked with the same values. The script will exit with an error when a query needs
+to scan a full table. Run this after changing the history queries or database migrations.
+"""
+
+import contextlib
+import gettext
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Only the queries on the history tables are checked
+QUERY = re.compile(
+    r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b.*\"(\w+History\w*|RelayUsage)\"", re.IGNORECASE | re.DOTALL
+)
+PARTITION = re.compile(r"^\s*ATTACH DATABASE '(?P<file>[^']+)' AS \"partition\"", re.IGNORECASE)
+
+# The same query with other values, or another amount of sensors, is only checked once
+VALUES = [(re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b"), "?"), (re.compile(r"\?(?:\s*,\s*\?)+"), "?")]
+
+# Matches full table scans like 'SCAN sh' (SQLite >= 3.36) and 'SCAN TABLE SensorHistory AS sh'. Scanning subqueries and constant rows is fine.
+# The limits change log only has a row per change, and is scanned once per query to join the limits as intervals.
+# The current limits of a sensor are a subquery of a single row.
+FULL_SCAN = re.compile(r"^SCAN (TABLE )?(?!\(|CONSTANT ROW|sl\b|current\b|SensorHistoryLimits\b)(?P<table>\S+)")
+
+# All the executed SQL with the partition that was attached to the connection at that moment
+statements = []
+# The queries that are already captured by a previous history function
+shapes = set()
+
+
+def trace_connections():
+    # Pony and TerrariumPI look up sqlite3.connect on every new connection, so every connection gets a trace
+    connect = sqlite3.connect
+
+    def traced_connect(*args, **kwargs):
+        connection = connect(*args, **kwargs)
+        attached = {"partition": None}
+
+        def trace(sql):
+            partition = PARTITION.match(sql)
+            if partition is not None:
+                attached["partition"] = partition.group("file")
+            elif sql.strip().upper().startswith("DETACH"):
+                attached["partition"] = None
+
+            statements.append((sql, attached["partition"]))
+
+        connection.set_trace_callback(trace)
+        return connection
+
+    sqlite3.connect = traced_connect
+
+
+def load_terrariumpi(database, partitions):
+    # The modules expect to run from the root folder of TerrariumPI
+    os.chdir(ROOT)
+    sys.path.insert(0, str(ROOT))
+    gettext.install("terrariumpi", "locales/")
+
+    # Load the logging first like terrariumPI.py does, as the database and the notifications import each other
+    import terrariumLogging
+    import terrariumDatabase
+
+    terrariumDatabase.DATABASE = database
+    terrariumDatabase.HISTORY_PARTITIONS = partitions
+    terrariumDatabase.init("query_plans")
+
+    return terrariumDatabase
+
+
+def capture(queries, name, action, session=True):
+    from pony import orm
+
+    start = len(statements)
+    # The cleanup uses its own transactions, which can not run inside an open write transaction
+    with orm.db_session() if session else contextlib.nullcontext():
+        result = action()
+        # Read all the rows of the streamed queries
+        if result is not None and hasattr(result, "__iter__"):
+            for _ in result:
+                pass
+
+    found = {}
+    for sql, partition in statements[start:]:
+        if QUERY.match(sql) is None:
+            continue
+
+        shape = sql
+        for pattern, replacement in VALUES:
+            shape = pattern.sub(replacement, shape)
+
+        shape = (" ".join(shape.split()), partition is not None)
+        if shape not in shapes:
+            shapes.add(shape)
+            found[shape] = (sql, partition)
+
+    for nr, (sql, partition) in enumerate(found.values()):
+        label = name if len(found) == 1 else f"{name} #{nr + 1}"
+        queries[f"{label} (partition)" if partition is not None else label] = (sql, partition)
+
+
+def run_history(terrariumDatabase, now):
+    sensors = ["plan-sensor-1", "plan-sensor-2"]
+    start = now - timedelta(days=120)
+    queries = {}
+
+    sensor = terrariumDatabase.Sensor
+    relay = terrariumDatabase.Relay
+    button = terrariumDatabase.Button
+    history = terrariumDatabase.SensorHistory
+
+    def create_devices():
+        for nr, sensor_id in enumerate(sensors):
+            sensor(id=sensor_id, hardware="plan", type="temperature", name=f"Sensor {nr}", address="plan")
+
+        relay(id="plan-relay", hardware="plan", name="Relay", address="plan", wattage=10, flow=1)
+        button(id="plan-button", hardware="plan", name="Button", address="plan")
+
+    capture(queries, "Create devices", create_devices)
+
+    # The cold start of the latest values loads the last value from the history
+    capture(queries, "Latest sensor value", lambda: sensor[sensors[0]].value)
+    capture(queries, "Latest relay value", lambda: relay["plan-relay"].value)
+    capture(queries, "Latest button value", lambda: button["plan-button"].value)
+
+    def store_old_history():
+        # Old history of a previous month, which is moved to a partition by the cleanup
+        for sensor_id in sensors:
+            history.merge(sensor_id, start, 20.0, 0.0, 50.0, 10.0, 40.0, False)
+
+    capture(queries, "Store sensor history", store_old_history)
+    capture(queries, "Update sensor rollups", history.update_rollups)
+    capture(queries, "Update sensor", lambda: [sensor[sensor_id].update(21.0) for sensor_id in sensors])
+    capture(queries, "Update relay", lambda: [relay["plan-relay"].update(value, True) for value in (100.0, 0.0)])
+    capture(queries, "Update button", lambda: button["plan-button"].update(1.0, True))
+
+    def cleanup():
+        terrariumDatabase.history_cleanup.set_retention(minute=3650, hourly=3650, daily=3650)
+        return terrariumDatabase.history_cleanup.run(datetime.now().timestamp() + 60)
+
+    capture(queries, "Clean up history", cleanup, session=False)
+
+    # The periods are read from the partitions and the main database
+    period = (start - timedelta(days=1), now + timedelta(minutes=1))
+    filters = {
+        "a single sensor": {"sensors": sensors[0]},
+        "a sensor type": {"sensor_type": "temperature"},
+        "selected sensors": {"sensors": sensors},
+    }
+    for resolution in ["minute", "hour", "day"]:
+        for name, sensor_filter in filters.items():
+            capture(
+                queries,
+                f"Sensor history for {name} per {resolution}",
+                lambda: history.history(*period, resolution=resolution, **sensor_filter),
+            )
+
+        capture(
+            queries,
+            f"Bulk sensor history per {resolution}",
+            lambda: history.bulk(sensors, *period, resolution=resolution),
+        )
+
+    capture(queries, "Sensor history export", lambda: history.export(sensors[0], *period))
+
+    for name, entity, device in [
+        ("relay", terrariumDatabase.RelayHistory, "plan-relay"),
+        ("button", terrariumDatabase.ButtonHistory, "plan-button"),
+    ]:
+        capture(queries, f"{name.capitalize()} history changes", lambda: entity.changes(device, *period))
+        capture(queries, f"{name.capitalize()} history export", lambda: entity.export(device, *period))
+        capture(queries, f"Bulk {name} history", lambda: entity.bulk([device], *period))
+        capture(queries, f"Bulk {name} history changes", lambda: entity.bulk([device], *period, changes=True))
+
+    return queries
+
+
+def check_query_plans(database, queries):
+    failed = []
+    for name, (query, partition) in queries.items():
+        with sqlite3.connect(database) as db:
+            if partition is not None:
+                db.execute('ATTACH DATABASE ? AS "partition"', (partition,))
+
+            plan = db.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+
+        scans = [row[3] for row in plan if FULL_SCAN.match(row[3])]
+
+        print(f"{'FAIL' if scans else 'OK':4} {name}")
+        for row in plan:
+            print(f"       {row[3]}")
+
+        if scans:
+            failed.append(name)
+
+    return failed
+
+
+trace_connections()
+with tempfile.TemporaryDirectory() as folder:
+    database = f"{folder}/terrariumpi.db"
+    terrariumDatabase = load_terrariumpi(database, f"{folder}/history")
+    queries = run_history(terrariumDatabase, datetime.now().replace(second=0, microsecond=0))
+    failed = check_query_plans(database, queries)
+
+if failed:
+    print(f"\n{len(failed)} queries are doing a full table scan: {', '.join(failed)}")
+    sys.exit(1)
+
+print(f"\nAll {len(queries)} queries are using an index")
@@ -62,7 +62,7 @@ const _setOnline = () => {
 const _reConnect = () => {
   // TODO: Start a reconnect trigger......???
   try {
-    websocket.set({ type: 'client_init', reconnect: true });
+    websocket.set({ type: 'client_init', reconnect: true, delta: true });
   } catch (e) {
     setTimeout(() => { _reConnect(); }, 30 * 1000);
   }
@@ -116,15 +116,23 @@ websocket.subscribe(message => {
       updateButton(message.data);
       break;
 
+    case 'snapshot':
+    case 'delta':
+      // All the (changed) sensors and relays of an update round in one message
+      (message.data.sensor || []).forEach(updateSensor);
+      (message.data.relay || []).forEach(updateRelay);
+      break;
+
     case 'logline':
       if (get(isAuthenticated)) {
         last_log_line.set(message.data);
       }
 
-      if (message.data.indexOf('WARNING') !== -1) {
-        animate_footer_badge('warning');
-      } else if (message.data.indexOf('ERROR') !== -1) {
+      // A batch can hold multiple log lines, so an error goes before a warning
+      if (message.data.indexOf('ERROR') !== -1) {
         animate_footer_badge('danger');
+      } else if (message.data.indexOf('WARNING') !== -1) {
+        animate_footer_badge('warning');
       }
       animate_footer_badge();
       break;
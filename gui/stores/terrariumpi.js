@@ -76,7 +76,7 @@ export const updateRelay = (relay) => {
 
   loaded_relays[relay.id] = { ...loaded_relays[relay.id], ...relay };
 
-  loaded_relays[relay.id].changed = old_state !== relay.value;
+  loaded_relays[relay.id].changed = old_state !== loaded_relays[relay.id].value;
   loaded_relays[relay.id].last_update = new Date();
 
   relays.set(loaded_relays);
@@ -17,6 +17,7 @@ from func_timeout import func_timeout, FunctionTimedOut
 from retry import retry
 
 from terrariumUtils import terrariumUtils, terrariumCache, classproperty
+from terrariumMetrics import metrics
 
 
 class terrariumRelayException(TypeError):
@@ -142,8 +143,11 @@ class terrariumRelay(object):
 
     @retry(terrariumRelayActionException, tries=3, delay=0.5, max_delay=2, logger=logger)
     def __set_hardware_value(self, state):
+        labels = {"device": "relay", "id": self.id, "hardware": self.HARDWARE, "action": "switch"}
         try:
-            action_ok = func_timeout(self._UPDATE_TIME_OUT, self._set_hardware_value, (state,))
+            with metrics.timer("terrariumpi_hardware_seconds", **labels):
+                action_ok = func_timeout(self._UPDATE_TIME_OUT, self._set_hardware_value, (state,))
+
             if action_ok:
                 # Update ok, store the new state
                 self._device["value"] = state
@@ -151,24 +155,30 @@ class terrariumRelay(object):
                 raise terrariumRelayActionException(f"Error changing relay {self} to state {state}. Error: unknown")
 
         except FunctionTimedOut:
+            metrics.inc("terrariumpi_hardware_timeouts_total", **labels)
             raise terrariumRelayLoadingException(
                 f"Error changing relay {self} to state {state}: Timed out after {self._UPDATE_TIME_OUT} seconds."
             )
         except Exception as ex:
+            metrics.inc("terrariumpi_hardware_errors_total", **labels)
             raise terrariumRelayActionException(f"Error changing relay {self} to state {state}. Error: {ex}")
 
     @retry(terrariumRelayUpdateException, tries=3, delay=0.5, max_delay=2, logger=logger)
     def __get_hardware_value(self):
         data = None
+        labels = {"device": "relay", "id": self.id, "hardware": self.HARDWARE, "action": "read"}
         try:
-            data = func_timeout(self._UPDATE_TIME_OUT, self._get_hardware_value)
+            with metrics.timer("terrariumpi_hardware_seconds", **labels):
+                data = func_timeout(self._UPDATE_TIME_OUT, self._get_hardware_value)
 
         except FunctionTimedOut:
+            metrics.inc("terrariumpi_hardware_timeouts_total", **labels)
             logger.error(f"Error getting new data from relay {self}: Timed out after {self._UPDATE_TIME_OUT} seconds.")
         except Exception as ex:
             logger.error(f"Error getting new data from relay {self}. Error: {ex}")
 
         if data is None:
+            metrics.inc("terrariumpi_hardware_errors_total", **labels)
             raise terrariumRelayUpdateException(f"Error getting new data from relay {self}. Error: unknown")
 
         return data
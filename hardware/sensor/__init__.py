@@ -28,6 +28,7 @@ import smbus2
 #from bluepy.btle import Scanner
 
 from terrariumUtils import terrariumUtils, terrariumCache, classproperty
+from terrariumMetrics import metrics
 
 
 class terrariumSensorException(TypeError):
@@ -292,12 +293,15 @@ class terrariumSensor(object):
     @retry(terrariumSensorUpdateException, tries=3, delay=0.5, max_delay=2, logger=logger)
     def get_data(self):
         data = None
+        labels = {"device": "sensor", "id": self.id, "hardware": self.HARDWARE, "action": "read"}
         self.__power_management(True)
 
         try:
-            data = func_timeout(self._UPDATE_TIME_OUT, self._get_data)
+            with metrics.timer("terrariumpi_hardware_seconds", **labels):
+                data = func_timeout(self._UPDATE_TIME_OUT, self._get_data)
         except FunctionTimedOut:
             # What ever fails... does not matter, as the data is still None and will raise a terrariumSensorUpdateException and trigger the retry
+            metrics.inc("terrariumpi_hardware_timeouts_total", **labels)
             logger.error(f"Sensor {self} timed out after {self._UPDATE_TIME_OUT} seconds during updating...")
         except Exception as ex:
             logger.error(f"Sensor {self} has exception: {ex}")
@@ -305,6 +309,7 @@ class terrariumSensor(object):
         self.__power_management(False)
 
         if data is None:
+            metrics.inc("terrariumpi_hardware_errors_total", **labels)
             raise terrariumSensorUpdateException(f"Invalid reading from sensor {self}")
 
         return data
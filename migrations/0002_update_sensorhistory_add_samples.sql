@@ -0,0 +1 @@
+ALTER TABLE "SensorHistory" ADD COLUMN "samples" INTEGER NOT NULL default 1;
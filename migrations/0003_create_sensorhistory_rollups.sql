@@ -0,0 +1,38 @@
+CREATE TABLE IF NOT EXISTS "SensorHistoryHourly" (
+	"sensor"	TEXT NOT NULL,
+	"timestamp"	DATETIME NOT NULL,
+	"value"	REAL NOT NULL,
+	"value_min"	REAL NOT NULL,
+	"value_max"	REAL NOT NULL,
+	"limit_min"	REAL NOT NULL,
+	"limit_max"	REAL NOT NULL,
+	"alarm_min"	REAL NOT NULL,
+	"alarm_max"	REAL NOT NULL,
+	"exclude_avg"	BOOLEAN NOT NULL,
+	"samples"	INTEGER NOT NULL,
+	PRIMARY KEY("sensor","timestamp"),
+	FOREIGN KEY("sensor") REFERENCES "Sensor"("id") ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS "SensorHistoryDaily" (
+	"sensor"	TEXT NOT NULL,
+	"timestamp"	DATETIME NOT NULL,
+	"value"	REAL NOT NULL,
+	"value_min"	REAL NOT NULL,
+	"value_max"	REAL NOT NULL,
+	"limit_min"	REAL NOT NULL,
+	"limit_max"	REAL NOT NULL,
+	"alarm_min"	REAL NOT NULL,
+	"alarm_max"	REAL NOT NULL,
+	"exclude_avg"	BOOLEAN NOT NULL,
+	"samples"	INTEGER NOT NULL,
+	PRIMARY KEY("sensor","timestamp"),
+	FOREIGN KEY("sensor") REFERENCES "Sensor"("id") ON DELETE CASCADE
+);
+INSERT OR REPLACE INTO "SensorHistoryHourly"
+	SELECT "sensor", strftime('%Y-%m-%d %H:00:00', "timestamp"), AVG("value"), MIN("value"), MAX("value"), AVG("limit_min"), AVG("limit_max"), AVG("alarm_min"), AVG("alarm_max"), MAX("exclude_avg"), COUNT(*)
+	FROM "SensorHistory"
+	GROUP BY "sensor", strftime('%Y-%m-%d %H:00:00', "timestamp");
+INSERT OR REPLACE INTO "SensorHistoryDaily"
+	SELECT "sensor", strftime('%Y-%m-%d 00:00:00', "timestamp"), SUM("value" * "samples") / SUM("samples"), MIN("value_min"), MAX("value_max"), SUM("limit_min" * "samples") / SUM("samples"), SUM("limit_max" * "samples") / SUM("samples"), SUM("alarm_min" * "samples") / SUM("samples"), SUM("alarm_max" * "samples") / SUM("samples"), MAX("exclude_avg"), SUM("samples")
+	FROM "SensorHistoryHourly"
+	GROUP BY "sensor", strftime('%Y-%m-%d 00:00:00', "timestamp");
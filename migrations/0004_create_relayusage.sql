@@ -0,0 +1,35 @@
+CREATE TABLE IF NOT EXISTS "RelayUsage" (
+	"relay"	TEXT NOT NULL,
+	"timestamp"	DATETIME NOT NULL,
+	"value"	REAL NOT NULL,
+	"wattage"	REAL NOT NULL,
+	"flow"	REAL NOT NULL,
+	"total_wattage"	REAL NOT NULL,
+	"total_flow"	REAL NOT NULL,
+	"duration"	REAL NOT NULL,
+	"period_start"	DATETIME,
+	"period_end"	DATETIME,
+	PRIMARY KEY("relay"),
+	FOREIGN KEY("relay") REFERENCES "Relay"("id") ON DELETE CASCADE
+);
+WITH "segments" AS (
+	SELECT "relay", "timestamp", "value", "wattage", "flow",
+		(JulianDay(LEAD("timestamp") OVER (PARTITION BY "relay" ORDER BY "timestamp")) - JulianDay("timestamp")) * 24 * 60 * 60 AS "duration",
+		LEAD("timestamp") OVER (PARTITION BY "relay" ORDER BY "timestamp") AS "next_timestamp",
+		ROW_NUMBER() OVER (PARTITION BY "relay" ORDER BY "timestamp" DESC) AS "last_row"
+	FROM "RelayHistory"
+	WHERE "relay" IN (SELECT "id" FROM "Relay")
+)
+INSERT OR REPLACE INTO "RelayUsage"
+	SELECT "relay",
+		MAX(CASE WHEN "last_row" = 1 THEN "timestamp" END),
+		MAX(CASE WHEN "last_row" = 1 THEN "value" END),
+		MAX(CASE WHEN "last_row" = 1 THEN "wattage" END),
+		MAX(CASE WHEN "last_row" = 1 THEN "flow" END),
+		TOTAL(CASE WHEN "value" > 0 THEN "duration" * "wattage" END),
+		TOTAL(CASE WHEN "value" > 0 THEN "duration" / 60.0 * "flow" END),
+		TOTAL(CASE WHEN "value" > 0 THEN "duration" END),
+		MIN(CASE WHEN "value" > 0 THEN "timestamp" END),
+		MAX(CASE WHEN "value" > 0 THEN "next_timestamp" END)
+	FROM "segments"
+	GROUP BY "relay";
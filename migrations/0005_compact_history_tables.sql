@@ -0,0 +1,63 @@
+CREATE TABLE IF NOT EXISTS "SensorHistoryLimits" (
+	"sensor"	TEXT NOT NULL,
+	"timestamp"	DATETIME NOT NULL,
+	"limit_min"	REAL NOT NULL,
+	"limit_max"	REAL NOT NULL,
+	"alarm_min"	REAL NOT NULL,
+	"alarm_max"	REAL NOT NULL,
+	"exclude_avg"	BOOLEAN NOT NULL,
+	PRIMARY KEY("sensor","timestamp"),
+	FOREIGN KEY("sensor") REFERENCES "Sensor"("id") ON DELETE CASCADE
+) WITHOUT ROWID;
+INSERT OR REPLACE INTO "SensorHistoryLimits"
+	SELECT "sensor", "timestamp", "limit_min", "limit_max", "alarm_min", "alarm_max", "exclude_avg"
+	FROM (
+		SELECT *,
+			LAG("limit_min") OVER "previous" AS "previous_limit_min",
+			LAG("limit_max") OVER "previous" AS "previous_limit_max",
+			LAG("alarm_min") OVER "previous" AS "previous_alarm_min",
+			LAG("alarm_max") OVER "previous" AS "previous_alarm_max",
+			LAG("exclude_avg") OVER "previous" AS "previous_exclude_avg",
+			ROW_NUMBER() OVER "previous" AS "row"
+		FROM "SensorHistory"
+		WINDOW "previous" AS (PARTITION BY "sensor" ORDER BY "timestamp")
+	)
+	WHERE "row" = 1
+		OR "limit_min" IS NOT "previous_limit_min"
+		OR "limit_max" IS NOT "previous_limit_max"
+		OR "alarm_min" IS NOT "previous_alarm_min"
+		OR "alarm_max" IS NOT "previous_alarm_max"
+		OR "exclude_avg" IS NOT "previous_exclude_avg";
+CREATE TABLE IF NOT EXISTS "SensorHistory_compact" (
+	"sensor"	TEXT NOT NULL,
+	"timestamp"	DATETIME NOT NULL,
+	"value"	REAL NOT NULL,
+	"samples"	INTEGER NOT NULL DEFAULT 1,
+	PRIMARY KEY("sensor","timestamp"),
+	FOREIGN KEY("sensor") REFERENCES "Sensor"("id") ON DELETE CASCADE
+) WITHOUT ROWID;
+INSERT INTO "SensorHistory_compact" SELECT "sensor", "timestamp", "value", "samples" FROM "SensorHistory";
+DROP TABLE "SensorHistory";
+ALTER TABLE "SensorHistory_compact" RENAME TO "SensorHistory";
+CREATE TABLE IF NOT EXISTS "RelayHistory_compact" (
+	"relay"	TEXT NOT NULL,
+	"timestamp"	DATETIME NOT NULL,
+	"value"	REAL NOT NULL,
+	"wattage"	REAL NOT NULL,
+	"flow"	REAL NOT NULL,
+	PRIMARY KEY("relay","timestamp"),
+	FOREIGN KEY("relay") REFERENCES "Relay"("id") ON DELETE CASCADE
+) WITHOUT ROWID;
+INSERT INTO "RelayHistory_compact" SELECT "relay", "timestamp", "value", "wattage", "flow" FROM "RelayHistory";
+DROP TABLE "RelayHistory";
+ALTER TABLE "RelayHistory_compact" RENAME TO "RelayHistory";
+CREATE TABLE IF NOT EXISTS "ButtonHistory_compact" (
+	"button"	TEXT NOT NULL,
+	"timestamp"	DATETIME NOT NULL,
+	"value"	REAL NOT NULL,
+	PRIMARY KEY("button","timestamp"),
+	FOREIGN KEY("button") REFERENCES "Button"("id") ON DELETE CASCADE
+) WITHOUT ROWID;
+INSERT INTO "ButtonHistory_compact" SELECT "button", "timestamp", "value" FROM "ButtonHistory";
+DROP TABLE "ButtonHistory";
+ALTER TABLE "ButtonHistory_compact" RENAME TO "ButtonHistory";
@@ -0,0 +1,3 @@
+CREATE INDEX IF NOT EXISTS "idx_sensor__type" ON "Sensor" (
+	"type"
+);
@@ -3,7 +3,14 @@ import terrariumLogging
 
 logger = terrariumLogging.logging.getLogger(__name__)
 
+import numpy
+import zlib
+import time
+import functools
+
 from datetime import datetime, timezone, timedelta
+from itertools import groupby
+from operator import itemgetter
 from pony import orm
 from bottle import request, response, static_file, HTTPError
 from json import dumps
@@ -19,18 +26,24 @@ from terrariumDatabase import (
     Area,
     Audiofile,
     Button,
+    ButtonHistory,
     Enclosure,
     Playlist,
     NotificationMessage,
     NotificationService,
     Relay,
+    RelayHistory,
     Sensor,
     SensorHistory,
     Setting,
     Webcam,
+    history_writer,
+    history_cleanup,
+    db_executor,
 )
 from terrariumEnclosure import terrariumEnclosure
 from terrariumNotification import terrariumNotification, terrariumNotificationService
+from terrariumMetrics import profiler
 
 from hardware.button import terrariumButton
 from hardware.display import terrariumDisplay
@@ -38,20 +51,153 @@ from hardware.relay import terrariumRelay
 from hardware.sensor import terrariumSensor
 from hardware.webcam import terrariumWebcam
 
-from terrariumUtils import terrariumUtils
+from terrariumUtils import terrariumUtils, terrariumSingleton
 
 # Set to false in production, else every API call that uses DB will produce a logline
 DEBUG = False
 
 
+class terrariumAPICache(terrariumSingleton):
+    """
+    Cache for the responses of the read only API routes. Every entry is tagged with the data it depends on, and the
+    engine invalidates the tags when that data changes. Clients that send the ETag back will get a 304 Not Modified.
+    """
+
+    __TIMEOUT = 5 * 60  # Fallback for changes that are not invalidated
+    __MAX_ENTRIES = 500
+
+    def __init__(self):
+        self.__cache = {}
+        self.__generations = {}
+        self.__stats = {"hits": 0, "misses": 0, "not_modified": 0}
+        logger.debug("Initialized API cache")
+
+    def __call__(self, *tags):
+        # Use as a route decorator: apply=[self.authentication(False), self.cache("sensors")]
+        tags = ("",) + tags
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                query = "&".join(sorted(f"{name}={value}" for name, value in request.query.allitems()))
+                key = f"{request.fullpath}?{query}"
+
+                entry = self.__cache.get(key)
+                if entry is None or entry["expire"] < time.time():
+                    self.__stats["misses"] += 1
+                    # When a tag is invalidated during the request, the response can already be outdated
+                    generations = [self.__generations.get(tag, 0) for tag in tags]
+
+                    data = func(*args, **kwargs)
+                    if isinstance(data, dict):
+                        body = dumps(data)
+                        response.content_type = "application/json"
+                    elif isinstance(data, bytes):
+                        body = data
+                    else:
+                        # Streamed responses are not cached
+                        return data
+
+                    entry = {
+                        "body": body,
+                        "etag": f'"{md5(body if isinstance(body, bytes) else body.encode()).hexdigest()}"',
+                        "headers": {
+                            name: value
+                            for name, value in response.headerlist
+                            if name.lower() == "content-type" or name.lower().startswith("x-")
+                        },
+                        "tags": tags,
+                        "expire": time.time() + terrariumAPICache.__TIMEOUT,
+                    }
+                    if generations == [self.__generations.get(tag, 0) for tag in tags]:
+                        self.__set(key, entry)
+
+                else:
+                    self.__stats["hits"] += 1
+
+                for name, value in entry["headers"].items():
+                    response.set_header(name, value)
+                response.set_header("ETag", entry["etag"])
+
+                if entry["etag"] in request.get_header("If-None-Match", ""):
+                    self.__stats["not_modified"] += 1
+                    response.status = 304
+                    return ""
+
+                return entry["body"]
+
+            return wrapper
+
+        return decorator
+
+    def __set(self, key, entry):
+        now = time.time()
+        for old_key in [old_key for old_key, old_entry in self.__cache.items() if old_entry["expire"] < now]:
+            del self.__cache[old_key]
+
+        if len(self.__cache) >= terrariumAPICache.__MAX_ENTRIES:
+            # Remove the oldest entry
+            del self.__cache[next(iter(self.__cache))]
+
+        self.__cache[key] = entry
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.__generations[tag] = self.__generations.get(tag, 0) + 1
+
+        for key in [key for key, entry in self.__cache.items() if set(tags) & set(entry["tags"])]:
+            del self.__cache[key]
+
+    def clear(self):
+        # All entries have the empty tag
+        self.invalidate("")
+
+    @property
+    def stats(self):
+        return {**self.__stats, "entries": len(self.__cache)}
+
+
+api_cache = terrariumAPICache()
+
+
 class terrariumAPI(object):
+    __HISTORY_MIN_POINTS = 150  # Minimum amount of points a graph should have when using rollup history data
+    __HISTORY_PERIODS = {"day": 1, "week": 7, "month": 31, "year": 365}
+    __EXPORT_CHUNK_LINES = 1000  # Lines per streamed export chunk
+
     def __init__(self, webserver):
         self.webserver = webserver
+        self.cache = api_cache
 
     # Always (force = True) enable authentication on the API
     def authentication(self, force=True):
         return self.webserver.authenticate(force)
 
+    # Run the read only handlers in a database thread, which has a read only database connection
+    def read_only(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not db_executor.running:
+                return func(*args, **kwargs)
+
+            environ = request.environ
+
+            def handler():
+                # The request and response are thread local, so bind them again in the database thread
+                request.bind(environ)
+                response.bind()
+                data = func(*args, **kwargs)
+                return data, response.status_line, list(response.headers.allitems())
+
+            data, status, headers = db_executor.run(handler)
+            response.status = status
+            for name, value in headers:
+                response.set_header(name, value)
+
+            return data
+
+        return wrapper
+
     def routes(self, bottle_app):
         # Area API
         bottle_app.route(
@@ -61,12 +207,16 @@ class terrariumAPI(object):
             "/api/areas/<area:path>/history/",
             "GET",
             self.area_detail_history,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("sensors", "enclosures"), self.read_only],
             name="api:area_history",
         )
 
         bottle_app.route(
-            "/api/areas/<area:path>/", "GET", self.area_detail, apply=self.authentication(False), name="api:area_detail"
+            "/api/areas/<area:path>/",
+            "GET",
+            self.area_detail,
+            apply=[self.authentication(False), self.read_only],
+            name="api:area_detail",
         )
 
         bottle_app.route(
@@ -75,7 +225,13 @@ class terrariumAPI(object):
         bottle_app.route(
             "/api/areas/<area:path>/", "DELETE", self.area_delete, apply=self.authentication(), name="api:area_delete"
         )
-        bottle_app.route("/api/areas/", "GET", self.area_list, apply=self.authentication(False), name="api:area_list")
+        bottle_app.route(
+            "/api/areas/",
+            "GET",
+            self.area_list,
+            apply=[self.authentication(False), self.read_only],
+            name="api:area_list",
+        )
         bottle_app.route("/api/areas/", "POST", self.area_add, apply=self.authentication(), name="api:area_add")
 
         # Audio API
@@ -83,7 +239,7 @@ class terrariumAPI(object):
             "/api/audio/files/<audiofile:path>/",
             "GET",
             self.audiofile_detail,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.read_only],
             name="api:audiofile_detail",
         )
         bottle_app.route(
@@ -94,7 +250,11 @@ class terrariumAPI(object):
             name="api:audiofile_delete",
         )
         bottle_app.route(
-            "/api/audio/files/", "GET", self.audiofile_list, apply=self.authentication(False), name="api:audiofile_list"
+            "/api/audio/files/",
+            "GET",
+            self.audiofile_list,
+            apply=[self.authentication(False), self.read_only],
+            name="api:audiofile_list",
         )
         bottle_app.route(
             "/api/audio/files/", "POST", self.audiofile_add, apply=self.authentication(), name="api:audiofile_add"
@@ -112,14 +272,14 @@ class terrariumAPI(object):
             "/api/buttons/<button:path>/history/<period:re:(day|week|month|year)>/",
             "GET",
             self.button_history,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("buttons"), self.read_only],
             name="api:button_history_period",
         )
         bottle_app.route(
             "/api/buttons/<button:path>/history/",
             "GET",
             self.button_history,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("buttons"), self.read_only],
             name="api:button_history",
         )
         bottle_app.route(
@@ -133,7 +293,7 @@ class terrariumAPI(object):
             "/api/buttons/<button:path>/",
             "GET",
             self.button_detail,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("buttons"), self.read_only],
             name="api:button_detail",
         )
         bottle_app.route(
@@ -151,7 +311,11 @@ class terrariumAPI(object):
             name="api:button_delete",
         )
         bottle_app.route(
-            "/api/buttons/", "GET", self.button_list, apply=self.authentication(False), name="api:button_list"
+            "/api/buttons/",
+            "GET",
+            self.button_list,
+            apply=[self.authentication(False), self.cache("buttons"), self.read_only],
+            name="api:button_list",
         )
         bottle_app.route("/api/buttons/", "POST", self.button_add, apply=self.authentication(), name="api:button_add")
 
@@ -204,7 +368,7 @@ class terrariumAPI(object):
             "/api/enclosures/<enclosure:path>/",
             "GET",
             self.enclosure_detail,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("enclosures", "buttons"), self.read_only],
             name="api:enclosure_detail",
         )
         bottle_app.route(
@@ -222,12 +386,26 @@ class terrariumAPI(object):
             name="api:enclosure_delete",
         )
         bottle_app.route(
-            "/api/enclosures/", "GET", self.enclosure_list, apply=self.authentication(False), name="api:enclosure_list"
+            "/api/enclosures/",
+            "GET",
+            self.enclosure_list,
+            apply=[self.authentication(False), self.cache("enclosures", "buttons"), self.read_only],
+            name="api:enclosure_list",
         )
         bottle_app.route(
             "/api/enclosures/", "POST", self.enclosure_add, apply=self.authentication(), name="api:enclosure_add"
         )
 
+        # History API
+        bottle_app.route(
+            "/api/history/bulk/",
+            "POST",
+            self.history_bulk,
+            apply=[self.authentication(False), self.read_only],
+            name="api:history_bulk",
+            read_only=True,
+        )
+
         # Logfile API
         bottle_app.route(
             "/api/logfile/download/",
@@ -236,6 +414,13 @@ class terrariumAPI(object):
             apply=self.authentication(),
             name="api:logfile_download",
         )
+        bottle_app.route(
+            "/api/logfile/recent/",
+            "GET",
+            self.logfile_recent,
+            apply=self.authentication(),
+            name="api:logfile_recent",
+        )
 
         # Notification API
         bottle_app.route(
@@ -249,7 +434,7 @@ class terrariumAPI(object):
             "/api/notification/messages/<message:path>/",
             "GET",
             self.notification_message_detail,
-            apply=self.authentication(),
+            apply=[self.authentication(), self.read_only],
             name="api:notification_message_detail",
         )
         bottle_app.route(
@@ -270,7 +455,7 @@ class terrariumAPI(object):
             "/api/notification/messages/",
             "GET",
             self.notification_message_list,
-            apply=self.authentication(),
+            apply=[self.authentication(), self.read_only],
             name="api:notification_message_list",
         )
         bottle_app.route(
@@ -291,7 +476,7 @@ class terrariumAPI(object):
             "/api/notification/services/<service:path>/",
             "GET",
             self.notification_service_detail,
-            apply=self.authentication(),
+            apply=[self.authentication(), self.read_only],
             name="api:notification_service_detail",
         )
         bottle_app.route(
@@ -312,7 +497,7 @@ class terrariumAPI(object):
             "/api/notification/services/",
             "GET",
             self.notification_service_list,
-            apply=self.authentication(),
+            apply=[self.authentication(), self.read_only],
             name="api:notification_service_list",
         )
         bottle_app.route(
@@ -328,7 +513,7 @@ class terrariumAPI(object):
             "/api/playlists/<playlist:path>/",
             "GET",
             self.playlist_detail,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.read_only],
             name="api:playlist_detail",
         )
         bottle_app.route(
@@ -346,7 +531,11 @@ class terrariumAPI(object):
             name="api:playlist_delete",
         )
         bottle_app.route(
-            "/api/playlists/", "GET", self.playlist_list, apply=self.authentication(False), name="api:playlist_list"
+            "/api/playlists/",
+            "GET",
+            self.playlist_list,
+            apply=[self.authentication(False), self.read_only],
+            name="api:playlist_list",
         )
         bottle_app.route(
             "/api/playlists/", "POST", self.playlist_add, apply=self.authentication(), name="api:playlist_add"
@@ -366,14 +555,14 @@ class terrariumAPI(object):
             "/api/relays/<relay:path>/<action:re:(history)>/<period:re:(day|week|month|year|replaced)>/",
             "GET",
             self.relay_history,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("relays"), self.read_only],
             name="api:relay_history_period",
         )
         bottle_app.route(
             "/api/relays/<relay:path>/<action:re:(history)>/",
             "GET",
             self.relay_history,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("relays"), self.read_only],
             name="api:relay_history",
         )
 
@@ -381,14 +570,14 @@ class terrariumAPI(object):
             "/api/relays/<relay:path>/<action:re:(export)>/<period:re:(day|week|month|year|replaced)>/",
             "GET",
             self.relay_history,
-            apply=self.authentication(),
+            apply=[self.authentication(), self.read_only],
             name="api:relay_export_period",
         )
         bottle_app.route(
             "/api/relays/<relay:path>/<action:re:(export)>/",
             "GET",
             self.relay_history,
-            apply=self.authentication(),
+            apply=[self.authentication(), self.read_only],
             name="api:relay_export",
         )
 
@@ -426,7 +615,7 @@ class terrariumAPI(object):
             "/api/relays/<relay:path>/",
             "GET",
             self.relay_detail,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("relays"), self.read_only],
             name="api:relay_detail",
         )
         bottle_app.route(
@@ -440,7 +629,11 @@ class terrariumAPI(object):
             name="api:relay_delete",
         )
         bottle_app.route(
-            "/api/relays/", "GET", self.relay_list, apply=self.authentication(False), name="api:relay_list"
+            "/api/relays/",
+            "GET",
+            self.relay_list,
+            apply=[self.authentication(False), self.cache("relays"), self.read_only],
+            name="api:relay_list",
         )
         bottle_app.route("/api/relays/", "POST", self.relay_add, apply=self.authentication(), name="api:relay_add")
 
@@ -450,63 +643,63 @@ class terrariumAPI(object):
             f"/api/sensors/<filter:re:({all_sensor_types})>/<action:re:(history)>/<period:re:(day|week|month|year)>/",
             "GET",
             self.sensor_history,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("sensors"), self.read_only],
             name="api:sensor_type_history_period",
         )
         bottle_app.route(
             f"/api/sensors/<filter:re:({all_sensor_types})>/<action:re:(export)>/<period:re:(day|week|month|year)>/",
             "GET",
             self.sensor_history,
-            apply=self.authentication(),
+            apply=[self.authentication(), self.read_only],
             name="api:sensor_type_export_period",
         )
         bottle_app.route(
             f"/api/sensors/<filter:re:({all_sensor_types})>/<action:re:(history)>/",
             "GET",
             self.sensor_history,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("sensors"), self.read_only],
             name="api:sensor_type_history",
         )
         bottle_app.route(
             f"/api/sensors/<filter:re:({all_sensor_types})>/<action:re:(export)>/",
             "GET",
             self.sensor_history,
-            apply=self.authentication(),
+            apply=[self.authentication(), self.read_only],
             name="api:sensor_type_export",
         )
         bottle_app.route(
             f"/api/sensors/<filter:re:({all_sensor_types})>/",
             "GET",
             self.sensor_list,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("sensors"), self.read_only],
             name="api:sensor_list_filtered",
         )
         bottle_app.route(
             "/api/sensors/<filter:path>/<action:re:(history)>/<period:re:(day|week|month|year)>/",
             "GET",
             self.sensor_history,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("sensors"), self.read_only],
             name="api:sensor_history_period",
         )
         bottle_app.route(
             "/api/sensors/<filter:path>/<action:re:(export)>/<period:re:(day|week|month|year)>/",
             "GET",
             self.sensor_history,
-            apply=self.authentication(),
+            apply=[self.authentication(), self.read_only],
             name="api:sensor_export_period",
         )
         bottle_app.route(
             "/api/sensors/<filter:path>/<action:re:(history)>/",
             "GET",
             self.sensor_history,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("sensors"), self.read_only],
             name="api:sensor_history",
         )
         bottle_app.route(
             "/api/sensors/<filter:path>/<action:re:(export)>/",
             "GET",
             self.sensor_history,
-            apply=self.authentication(),
+            apply=[self.authentication(), self.read_only],
             name="api:sensor_export",
         )
         bottle_app.route(
@@ -523,7 +716,7 @@ class terrariumAPI(object):
             "/api/sensors/<sensor:path>/",
             "GET",
             self.sensor_detail,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.cache("sensors"), self.read_only],
             name="api:sensor_detail",
         )
         bottle_app.route(
@@ -541,7 +734,11 @@ class terrariumAPI(object):
             name="api:sensor_delete",
         )
         bottle_app.route(
-            "/api/sensors/", "GET", self.sensor_list, apply=self.authentication(False), name="api:sensor_list"
+            "/api/sensors/",
+            "GET",
+            self.sensor_list,
+            apply=[self.authentication(False), self.cache("sensors"), self.read_only],
+            name="api:sensor_list",
         )
         bottle_app.route("/api/sensors/", "POST", self.sensor_add, apply=self.authentication(), name="api:sensor_add")
 
@@ -550,7 +747,7 @@ class terrariumAPI(object):
             "/api/settings/<setting:path>/",
             "GET",
             self.setting_detail,
-            apply=self.authentication(),
+            apply=[self.authentication(), self.read_only],
             name="api:setting_detail",
         )
         bottle_app.route(
@@ -576,7 +773,11 @@ class terrariumAPI(object):
             name="api:setting_update_multi",
         )
         bottle_app.route(
-            "/api/settings/", "GET", self.setting_list, apply=self.authentication(), name="api:setting_list"
+            "/api/settings/",
+            "GET",
+            self.setting_list,
+            apply=[self.authentication(), self.read_only],
+            name="api:setting_list",
         )
         bottle_app.route(
             "/api/settings/", "POST", self.setting_add, apply=self.authentication(), name="api:setting_add"
@@ -586,6 +787,13 @@ class terrariumAPI(object):
         bottle_app.route(
             "/api/system_status/", "GET", self.system_status, apply=self.authentication(False), name="api:system_status"
         )
+        bottle_app.route(
+            "/api/system_profile/",
+            "GET",
+            self.system_profile,
+            apply=self.authentication(False),
+            name="api:system_profile",
+        )
 
         # Weather API
         bottle_app.route(
@@ -604,7 +812,7 @@ class terrariumAPI(object):
             "/api/webcams/<webcam:path>/archive/<period:path>",
             "GET",
             self.webcam_archive,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.read_only],
             name="api:webcam_archive",
         )
         bottle_app.route(
@@ -618,7 +826,7 @@ class terrariumAPI(object):
             "/api/webcams/<webcam:path>/",
             "GET",
             self.webcam_detail,
-            apply=self.authentication(False),
+            apply=[self.authentication(False), self.read_only],
             name="api:webcam_detail",
         )
         bottle_app.route(
@@ -636,7 +844,11 @@ class terrariumAPI(object):
             name="api:webcam_delete",
         )
         bottle_app.route(
-            "/api/webcams/", "GET", self.webcam_list, apply=self.authentication(False), name="api:webcam_list"
+            "/api/webcams/",
+            "GET",
+            self.webcam_list,
+            apply=[self.authentication(False), self.read_only],
+            name="api:webcam_list",
         )
         bottle_app.route("/api/webcams/", "POST", self.webcam_add, apply=self.authentication(), name="api:webcam_add")
 
@@ -649,6 +861,127 @@ class terrariumAPI(object):
             name="api:documentation",
         )
 
+    def __history_resolution(self, period):
+        # Pick the coarsest resolution that still gives enough points for the requested period (in days)
+        for resolution, points_per_day in [("day", 1), ("hour", 24)]:
+            if period * points_per_day >= terrariumAPI.__HISTORY_MIN_POINTS:
+                return resolution
+
+        return "minute"
+
+    def __history_range(self, parameters=None):
+        # Optional start, end and since query parameters as epoch timestamps
+        parameters = request.query if parameters is None else parameters
+        history_range = {}
+        for field in ["start", "end", "since"]:
+            value = parameters.get(field, None)
+            if value is None:
+                continue
+
+            try:
+                history_range[field] = datetime.fromtimestamp(float(value))
+            except (ValueError, OverflowError, OSError):
+                raise HTTPError(status=400, body=f"Invalid {field} value {value}. Should be an epoch timestamp.")
+
+        if "start" in history_range and "end" in history_range and history_range["start"] >= history_range["end"]:
+            raise HTTPError(status=400, body="Invalid range. The start should be before the end.")
+
+        return history_range
+
+    def __history_period(self, period, history_range):
+        # Returns the period in days that selects the resolution, and the start and end of the requested range
+        now = datetime.now()
+        end = history_range.get("end", datetime.max)
+        start = history_range.get("start", min(end, now) - timedelta(days=period))
+        period = (min(end, now) - start).total_seconds() / (24.0 * 3600.0)
+
+        if "since" in history_range:
+            if "minute" == self.__history_resolution(period):
+                # Only the rows that are newer than the last point of the client
+                start = max(start, history_range["since"] + timedelta(microseconds=1))
+            else:
+                # The last hourly or daily rollup is still updated, so return that one again
+                start = max(start, history_range["since"])
+
+        return period, start, end
+
+    def __max_points(self, parameters=None):
+        parameters = request.query if parameters is None else parameters
+        max_points = parameters.get("max_points", None)
+        if max_points is None:
+            return None
+
+        try:
+            max_points = int(max_points)
+        except ValueError:
+            raise HTTPError(status=400, body=f"Invalid max_points value {max_points}. Should be a number.")
+
+        # The downsampling always keeps the first and last point, and the lowest and highest point of every bucket
+        if max_points < 4:
+            raise HTTPError(status=400, body=f"Invalid max_points value {max_points}. Should be at least 4.")
+
+        return max_points
+
+    def __history_format(self, formats, parameters=None):
+        parameters = request.query if parameters is None else parameters
+        output = parameters.get("format", formats[0])
+        if output not in formats:
+            raise HTTPError(
+                status=400, body=f"Invalid format {output}. Should be {', '.join(formats[:-1])} or {formats[-1]}."
+            )
+
+        return output
+
+    def __history_columns(self, fields, rows, max_points):
+        # Transpose the rows to columns. The first field is the timestamp, the second the value
+        columns = [list(column) for column in zip(*rows)] or [[] for _ in fields]
+        columns[0] = [timestamp.timestamp() for timestamp in columns[0]]
+
+        if max_points is not None and len(columns[0]) > max_points:
+            order = numpy.argsort(columns[0], kind="stable")
+            order = order[terrariumUtils.downsample([columns[1][index] for index in order], max_points)]
+            columns = [[column[index] for index in order] for column in columns]
+
+        return columns
+
+    def __history_data(self, fields, rows, max_points, output):
+        columns = self.__history_columns(fields, rows, max_points)
+
+        if "columns" == output:
+            return {"data": dict(zip(fields, columns))}
+
+        elif "binary" == output:
+            # Little endian float64 arrays per field after each other, missing values are NaN
+            response.headers["Content-Type"] = "application/octet-stream"
+            response.headers["X-History-Fields"] = ",".join(fields)
+            response.headers["X-History-Points"] = str(len(columns[0]))
+            return numpy.array(columns, dtype="<f8").tobytes()
+
+        return {"data": [dict(zip(fields, row)) for row in zip(*columns)]}
+
+    def __export_csv(self, filename, fields, rows):
+        # Stream the CSV in chunks, so a large export does not need to fit in memory
+        compress = terrariumUtils.is_true(request.query.get("gzip", False))
+
+        response.headers["Content-Type"] = "application/gzip" if compress else "application/csv"
+        response.headers["Content-Disposition"] = f"attachment; filename={filename}.csv{'.gz' if compress else ''}"
+
+        def csv_data():
+            encoder = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+            lines = [";".join(fields)]
+            for row in rows:
+                lines.append(";".join([str(value) for value in row]))
+                if len(lines) == terrariumAPI.__EXPORT_CHUNK_LINES:
+                    chunk = ("\n".join(lines) + "\n").encode()
+                    lines = []
+                    yield encoder.compress(chunk) if compress else chunk
+
+            chunk = ("\n".join(lines) + "\n").encode() if len(lines) > 0 else b""
+            yield encoder.compress(chunk) + encoder.flush() if compress else chunk
+
+        # Read the rows in the database threads, so the web server keeps running while the export is streamed
+        return db_executor.stream(csv_data())
+
     # Areas
     def area_types(self):
         return {"data": terrariumArea.available_areas}
@@ -843,11 +1176,12 @@ class terrariumAPI(object):
 
     @orm.db_session(sql_debug=DEBUG, show_values=DEBUG)
     def button_history(self, button, action="history", period="day"):
+        max_points = self.__max_points()
+        output = self.__history_format(["rows", "columns", "binary"])
+        history_range = self.__history_range()
         try:
             button = Button[button]
 
-            data = []
-
             if "day" == period:
                 period = 1
             elif "week" == period:
@@ -859,28 +1193,31 @@ class terrariumAPI(object):
             else:
                 period = 1
 
-            for item in button.history.filter(lambda h: h.timestamp >= datetime.now() - timedelta(days=period)):
-                data.append(
-                    {
-                        "timestamp": item.timestamp.timestamp(),
-                        "value": item.value,
-                    }
-                )
+            period, start, end = self.__history_period(period, history_range)
 
             if "export" == action:
-                response.headers["Content-Type"] = "application/csv"
-                response.headers["Content-Disposition"] = f"attachment; filename={button.name}_{period}.csv"
+                return self.__export_csv(
+                    f"{button.name}_{period:.0f}",
+                    ["timestamp", "value"],
+                    ButtonHistory.export(button.id, start, end),
+                )
 
-                # CSV Headers
-                csv_data = ";".join(data[0].keys()) + "\n"
-                # Data
-                for data_point in data:
-                    data_point["timestamp"] = datetime.fromtimestamp(data_point["timestamp"])
-                    csv_data += ";".join([str(value) for value in data_point.values()]) + "\n"
+            resolution = self.__history_resolution(period)
 
-                return csv_data
+            # Run the query in a database thread, so the web server keeps running
+            @orm.db_session(sql_debug=DEBUG, show_values=DEBUG)
+            def history_query(button):
+                if "minute" == resolution:
+                    query = Button[button].history.filter(lambda h: h.timestamp >= start and h.timestamp < end)
+                else:
+                    # Buttons store changes and a forced update every hour. For longer periods only use the changes
+                    query = ButtonHistory.changes(button, start, end)
 
-            return {"data": data}
+                return [(item.timestamp, item.value) for item in query]
+
+            return self.__history_data(
+                ["timestamp", "value"], db_executor.run(history_query, button.id), max_points, output
+            )
 
         except orm.core.ObjectNotFound:
             raise HTTPError(status=404, body=f"Button with id {button} does not exists.")
@@ -1149,12 +1486,112 @@ class terrariumAPI(object):
         except Exception as ex:
             raise HTTPError(status=500, body=f"Error deleting enclosure {enclosure}. {ex}")
 
+    # History
+    def history_bulk(self):
+        try:
+            parameters = request.json
+        except ValueError:
+            parameters = None
+
+        if not isinstance(parameters, dict):
+            raise HTTPError(status=400, body="Invalid request. Should be a JSON object.")
+
+        devices = {}
+        for device_type in ["sensors", "relays", "buttons"]:
+            ids = parameters.get(device_type, [])
+            if not isinstance(ids, list) or not all(isinstance(device, str) for device in ids):
+                raise HTTPError(status=400, body=f"Invalid {device_type} value. Should be a list of ids.")
+
+            # Remove duplicate ids, but keep the order
+            devices[device_type] = list(dict.fromkeys(ids))
+
+        period = parameters.get("period", "day")
+        if period not in terrariumAPI.__HISTORY_PERIODS:
+            periods = ", ".join(terrariumAPI.__HISTORY_PERIODS)
+            raise HTTPError(status=400, body=f"Invalid period {period}. Should be one of {periods}.")
+
+        max_points = self.__max_points(parameters)
+        period, start, end = self.__history_period(
+            terrariumAPI.__HISTORY_PERIODS[period], self.__history_range(parameters)
+        )
+
+        resolution = parameters.get("resolution", self.__history_resolution(period))
+        if resolution not in ["minute", "hour", "day"]:
+            raise HTTPError(status=400, body=f"Invalid resolution {resolution}. Should be minute, hour or day.")
+
+        output = self.__history_format(["rows", "columns"], parameters)
+
+        # One query per history table for all the devices. Relays and buttons only use the changes for longer periods
+        changes = "minute" != resolution
+        queries = {
+            "sensors": (
+                ["timestamp", "value", "alarm_min", "alarm_max"],
+                SensorHistory.bulk(devices["sensors"], start, end, resolution) if devices["sensors"] else [],
+            ),
+            "relays": (
+                ["timestamp", "value", "wattage", "flow"],
+                RelayHistory.bulk(devices["relays"], start, end, changes) if devices["relays"] else [],
+            ),
+            "buttons": (
+                ["timestamp", "value"],
+                ButtonHistory.bulk(devices["buttons"], start, end, changes) if devices["buttons"] else [],
+            ),
+        }
+
+        def device_data(fields, rows):
+            columns = self.__history_columns(
+                fields, ((datetime.fromisoformat(row[1]), *row[2:]) for row in rows), max_points
+            )
+            if "columns" == output:
+                return dict(zip(fields, columns))
+
+            return [dict(zip(fields, row)) for row in zip(*columns)]
+
+        def bulk_data():
+            # Stream the history per device, so the rows of all the devices never have to be in memory at once
+            yield '{"data": {'
+            for type_index, (device_type, (fields, rows)) in enumerate(queries.items()):
+                yield f'{", " if type_index > 0 else ""}"{device_type}": {{'
+
+                separator = ""
+                missing = list(devices[device_type])
+                for device, device_rows in groupby(rows, key=itemgetter(0)):
+                    missing.remove(device)
+                    yield f"{separator}{dumps(device)}: {dumps(device_data(fields, device_rows))}"
+                    separator = ", "
+
+                # Devices without history in the period
+                for device in missing:
+                    yield f"{separator}{dumps(device)}: {dumps(device_data(fields, []))}"
+                    separator = ", "
+
+                yield "}"
+
+            yield "}}"
+
+        response.content_type = "application/json"
+        # Read the rows in the database threads, so the web server keeps running while the history is streamed
+        return db_executor.stream(bulk_data())
+
     # Logfile
     def logfile_download(self):
         # https://stackoverflow.com/a/26017181
-        logfile = Path(terrariumLogging.logging.getLogger().handlers[1].baseFilename)
+        logfile = Path(terrariumLogging.root_handlers[1].baseFilename)
         return static_file(logfile.name, root="log", mimetype="text/text", download=logfile.name)
 
+    def logfile_recent(self):
+        # The last log lines from memory, oldest first. Use the sequence as `since` to get only the newer lines
+        try:
+            since = int(request.query.get("since", 0))
+        except ValueError:
+            raise HTTPError(status=400, body="Invalid since value")
+
+        lines = terrariumLogging.log_buffer.lines(since)
+        return {
+            "data": [line for _, line in lines],
+            "sequence": lines[-1][0] if len(lines) > 0 else min(max(since, 0), terrariumLogging.log_buffer.sequence),
+        }
+
     # Notifications
     def notification_message_types(self):
         return {"data": terrariumNotification.available_messages}
@@ -1406,11 +1843,12 @@ class terrariumAPI(object):
 
     @orm.db_session(sql_debug=DEBUG, show_values=DEBUG)
     def relay_history(self, relay, action="history", period="day"):
+        max_points = self.__max_points()
+        output = self.__history_format(["rows", "columns", "binary"])
+        history_range = self.__history_range()
         try:
             relay = Relay[relay]
 
-            data = []
-
             if "day" == period:
                 period = 1
             elif "week" == period:
@@ -1425,30 +1863,31 @@ class terrariumAPI(object):
             else:
                 period = 1
 
-            for item in relay.history.filter(lambda h: h.timestamp >= datetime.now() - timedelta(days=period)):
-                data.append(
-                    {
-                        "timestamp": item.timestamp.timestamp(),
-                        "value": item.value,
-                        "wattage": item.wattage,
-                        "flow": item.flow,
-                    }
-                )
+            period, start, end = self.__history_period(period, history_range)
 
             if "export" == action:
-                response.headers["Content-Type"] = "application/csv"
-                response.headers["Content-Disposition"] = f"attachment; filename={relay.name}_{period}.csv"
+                return self.__export_csv(
+                    f"{relay.name}_{period:.0f}",
+                    ["timestamp", "value", "wattage", "flow"],
+                    RelayHistory.export(relay.id, start, end),
+                )
 
-                # CSV Headers
-                csv_data = ";".join(data[0].keys()) + "\n"
-                # Data
-                for data_point in data:
-                    data_point["timestamp"] = datetime.fromtimestamp(data_point["timestamp"])
-                    csv_data += ";".join([str(value) for value in data_point.values()]) + "\n"
+            resolution = self.__history_resolution(period)
 
-                return csv_data
+            # Run the query in a database thread, so the web server keeps running
+            @orm.db_session(sql_debug=DEBUG, show_values=DEBUG)
+            def history_query(relay):
+                if "minute" == resolution:
+                    query = Relay[relay].history.filter(lambda h: h.timestamp >= start and h.timestamp < end)
+                else:
+                    # Relays store changes and a forced update every 15 minutes. For longer periods only use the changes
+                    query = RelayHistory.changes(relay, start, end)
 
-            return {"data": data}
+                return [(item.timestamp, item.value, item.wattage, item.flow) for item in query]
+
+            return self.__history_data(
+                ["timestamp", "value", "wattage", "flow"], db_executor.run(history_query, relay.id), max_points, output
+            )
 
         except orm.core.ObjectNotFound:
             raise HTTPError(status=404, body=f"Relay with id {relay} does not exists.")
@@ -1531,7 +1970,9 @@ class terrariumAPI(object):
     # Sensors
     @orm.db_session(sql_debug=DEBUG, show_values=DEBUG)
     def sensor_history(self, filter=None, action="history", period="day"):
-        data = []
+        max_points = self.__max_points()
+        output = self.__history_format(["rows", "columns", "binary"])
+        history_range = self.__history_range()
 
         if "day" == period:
             period = 1
@@ -1544,62 +1985,38 @@ class terrariumAPI(object):
         else:
             period = 1
 
-        if isinstance(filter, list):
-            # Get history based on selected sensor IDs
-            query = orm.select(
-                (sh.timestamp, orm.avg(sh.value), orm.avg(sh.alarm_min), orm.avg(sh.alarm_max))
-                for sh in SensorHistory
-                if sh.sensor.id in filter
-                and sh.exclude_avg == False
-                and sh.timestamp >= datetime.now() - timedelta(days=period)
-            )
-
-        elif filter in terrariumSensor.sensor_types:
-            query = orm.select(
-                (sh.timestamp, orm.avg(sh.value), orm.avg(sh.alarm_min), orm.avg(sh.alarm_max))
-                for sh in SensorHistory
-                if sh.sensor.type == filter
-                and sh.exclude_avg == False
-                and sh.timestamp >= datetime.now() - timedelta(days=period)
-            )
-
-        else:
-            query = orm.select(
-                (sh.timestamp, sh.value, sh.alarm_min, sh.alarm_max, sh.limit_min, sh.limit_max)
-                for sh in SensorHistory
-                if sh.sensor.id == filter and sh.timestamp >= datetime.now() - timedelta(days=period)
-            )
-
-        for item in query:
-            data_point = {
-                "timestamp": item[0].timestamp(),
-                "value": item[1],
-                "alarm_min": item[2],
-                "alarm_max": item[3],
-            }
-            if "export" == action:
-                data_point["limit_min"] = item[4]
-                data_point["limit_max"] = item[5]
-                data_point["alarm"] = not data_point["alarm_min"] <= data_point["value"] <= data_point["alarm_max"]
-
-            data.append(data_point)
+        period, start, end = self.__history_period(period, history_range)
 
         if "export" == action:
             sensor = Sensor[filter]
-            response.headers["Content-Type"] = "application/csv"
-            response.headers["Content-Disposition"] = f"attachment; filename={sensor.name}_{period}.csv"
+            return self.__export_csv(
+                f"{sensor.name}_{period:.0f}",
+                ["timestamp", "value", "alarm_min", "alarm_max", "limit_min", "limit_max", "alarm"],
+                (
+                    row + (not row[2] <= row[1] <= row[3],)
+                    for row in SensorHistory.export(sensor.id, start, end)
+                ),
+            )
 
-            # CSV Headers
-            csv_data = ";".join(data[0].keys()) + "\n"
-            # Data
-            for data_point in data:
-                data_point["timestamp"] = datetime.fromtimestamp(data_point["timestamp"])
-                csv_data += ";".join([str(value) for value in data_point.values()]) + "\n"
+        resolution = self.__history_resolution(period)
+
+        # Run the query in a database thread, so the web server keeps running
+        def history_query():
+            # The minute history joins the limits and alarm values from the change log entry that was active at the
+            # time of the measurement. The hour and day resolutions use the hourly or daily rollups
+            if isinstance(filter, list):
+                # Get history based on selected sensor IDs
+                rows = SensorHistory.history(start, end, sensors=filter, resolution=resolution)
+            elif filter in terrariumSensor.sensor_types:
+                rows = SensorHistory.history(start, end, sensor_type=filter, resolution=resolution)
+            else:
+                rows = SensorHistory.history(start, end, sensors=filter, resolution=resolution)
 
-            return csv_data
+            return [(datetime.fromisoformat(row[0]), *row[1:]) for row in rows]
 
-        else:
-            return {"data": data}
+        return self.__history_data(
+            ["timestamp", "value", "alarm_min", "alarm_max"], db_executor.run(history_query), max_points, output
+        )
 
     def sensor_hardware(self):
         return {"data": terrariumSensor.available_sensors}
@@ -1813,8 +2230,15 @@ class terrariumAPI(object):
         motd_text = Path("motd.sh").read_text().split("\n")
         motd_text = motd_text[1:-1]
         data["summary"] = conv.convert("\n".join(motd_text).replace('echo "', "").replace("\`", "`"), full=True)
+        data["history_writer"] = history_writer.stats
+        data["history_cleanup"] = history_cleanup.stats
+        data["api_cache"] = self.cache.stats
+        data["db_executor"] = db_executor.stats
         return data
 
+    def system_profile(self):
+        return {"data": profiler.rounds}
+
     # Weather
     def weather_detail(self):
         weather = {}
@@ -1,19 +1,30 @@
 # -*- coding: utf-8 -*-
+import terrariumLogging
+
+logger = terrariumLogging.logging.getLogger(__name__)
+
 from datetime import datetime, timedelta
+from gevent import spawn, sleep
+from gevent.threadpool import ThreadPool
 from pony import orm
 from yoyo import read_migrations
 from yoyo import get_backend
 from dotenv import dotenv_values
 from pathlib import Path
-from terrariumUtils import terrariumUtils
+from terrariumUtils import terrariumUtils, terrariumSingleton
+from terrariumMetrics import metrics
 
 import copy
+import heapq
 import re
 import sqlite3
+import threading
 import time
 
 DATABASE = "data/terrariumpi.db"
+HISTORY_PARTITIONS = "data/history"
 ADVANCED_SETTINGS_FILE = "data/.database-env"
+HUB_PAUSE = 0.001  # Seconds to give the gevent hub between the batches of long running database work
 
 db = orm.Database()
 
@@ -21,7 +32,7 @@ db = orm.Database()
 @db.on_connect(provider="sqlite")
 def sqlite_speedups(db, connection):
     settings = {
-        "auto_vacuum": "NONE",
+        "auto_vacuum": "INCREMENTAL",
         "cache_size": -10000,
         "journal_mode": "WAL",
         "synchronous": "OFF",
@@ -33,8 +44,19 @@ def sqlite_speedups(db, connection):
     for key, value in settings.items():
         cursor.execute(f"PRAGMA {key}  = {value}")
 
+    # The connections of the database threads are only used for reading. With WAL they can read while the engine writes
+    if db_executor.reader:
+        cursor.execute("PRAGMA query_only = ON")
+
 
 def init(version):
+    if not Path(DATABASE).exists():
+        # The auto vacuum mode can only be set before the first table is created
+        new_db = sqlite3.connect(DATABASE)
+        new_db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        new_db.execute("VACUUM")
+        new_db.close()
+
     backend = get_backend(f"sqlite:///{DATABASE}")
     migrations = read_migrations("migrations")
 
@@ -76,6 +98,10 @@ def create_defaults(version):
         {"id": "all_gauges_on_single_page", "value": "false"},
         {"id": "graph_smooth_value", "value": "0"},
         {"id": "auto_dark_mode", "value": "0"},
+        {"id": "history_retention_minute", "value": "0"},
+        {"id": "history_retention_hourly", "value": "0"},
+        {"id": "history_retention_daily", "value": "0"},
+        {"id": "database_threads", "value": "2"},
     ]
 
     for setting in setting_defaults:
@@ -94,6 +120,736 @@ def load_advanced_settings():
     return {}
 
 
+class terrariumLatestValues(terrariumSingleton):
+    """
+    Process wide store of the latest history value per device. The history entities update this store when a new
+    value is written, so reading the current value of a sensor, relay or button does not need a history query.
+    The database is only queried once per device as a cold start fallback.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__values = {}
+
+    def set(self, device_type, device_id, timestamp, value):
+        key = (device_type, device_id)
+        with self.__lock:
+            current = self.__values.get(key)
+            # Never overwrite a newer value with an older one
+            if current is None or current[0] is None or timestamp is None or timestamp >= current[0]:
+                self.__values[key] = (timestamp, value)
+
+    def get(self, device_type, device_id, max_age):
+        """
+        Get the latest value of a device
+
+        Returns a tuple (known, value). When known is False, the store has no information and the database should be
+        queried. The value is None when the latest value is older than max_age seconds.
+        """
+        with self.__lock:
+            entry = self.__values.get((device_type, device_id))
+
+        if entry is None:
+            return (False, None)
+
+        timestamp, value = entry
+        if timestamp is None or timestamp < datetime.now() - timedelta(seconds=max_age):
+            return (True, None)
+
+        return (True, value)
+
+    def clear(self, device_type=None, device_id=None):
+        with self.__lock:
+            for key in list(self.__values.keys()):
+                if (device_type is None or device_type == key[0]) and (device_id is None or device_id == key[1]):
+                    del self.__values[key]
+
+
+latest_values = terrariumLatestValues()
+
+
+class terrariumHistoryWriter(terrariumSingleton):
+    """
+    Write-behind queue for history data. Instead of a small transaction per device, history rows are queued and
+    written by a single writer in one transaction. The queue is flushed once per engine round, or when the queue is
+    getting too big or too old. When the writer is not started, history rows are written directly.
+
+    Callbacks registered with on_flush run at the end of every flush in the same transaction, like the sensor rollups.
+    """
+
+    __MAX_QUEUE_SIZE = 250  # Flush when this amount of history rows are waiting
+    __MAX_QUEUE_AGE = 10  # Flush at least every x seconds
+
+    def __init__(self):
+        self.__queue = []
+        self.__flush_callbacks = []
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__thread = None
+        self.__running = False
+
+        self.__stats = {
+            "flushes": 0,
+            "rows": 0,
+            "errors": 0,
+            "last_duration": 0.0,
+            "max_duration": 0.0,
+            "total_duration": 0.0,
+        }
+
+    def __writer(self):
+        logger.info("Starting history writer.")
+        while self.__running:
+            self.__wakeup.wait(terrariumHistoryWriter.__MAX_QUEUE_AGE)
+            self.__wakeup.clear()
+            self.flush()
+
+        logger.info("Stopped history writer.")
+
+    @property
+    def running(self):
+        return self.__running
+
+    @property
+    def queue_depth(self):
+        with self.__lock:
+            return len(self.__queue)
+
+    @property
+    def stats(self):
+        with self.__lock:
+            stats = copy.copy(self.__stats)
+            stats["queue_depth"] = len(self.__queue)
+
+        stats["average_duration"] = 0.0 if stats["flushes"] == 0 else stats["total_duration"] / stats["flushes"]
+        return stats
+
+    def start(self):
+        if self.__running:
+            return
+
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__writer)
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        self.__wakeup.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+        # Write the last queued history data
+        self.flush()
+
+    def on_flush(self, callback):
+        self.__flush_callbacks.append(callback)
+
+    def __run_flush_callbacks(self):
+        for callback in self.__flush_callbacks:
+            callback()
+
+    def add(self, action, **data):
+        # Without a running writer, store the history data directly in the current db_session
+        if not self.__running:
+            result = action(**data)
+            self.__run_flush_callbacks()
+            return result
+
+        with self.__lock:
+            self.__queue.append((action, data))
+            queue_size = len(self.__queue)
+
+        if queue_size >= terrariumHistoryWriter.__MAX_QUEUE_SIZE:
+            self.__wakeup.set()
+
+    def flush(self):
+        with self.__flush_lock:
+            with self.__lock:
+                items = self.__queue
+                self.__queue = []
+
+            if len(items) == 0:
+                return 0
+
+            start = time.time()
+            errors = 0
+            try:
+                with orm.db_session():
+                    for action, data in items:
+                        action(**data)
+
+                    self.__run_flush_callbacks()
+
+            except Exception as ex:
+                logger.warning(f"Error writing {len(items)} history rows in one transaction. Retrying one by one: {ex}")
+                for action, data in items:
+                    try:
+                        with orm.db_session():
+                            action(**data)
+                    except Exception as ex:
+                        errors += 1
+                        logger.error(f"Could not write history data {data}: {ex}")
+
+                try:
+                    with orm.db_session():
+                        self.__run_flush_callbacks()
+                except Exception as ex:
+                    logger.error(f"Could not finish the history data: {ex}")
+
+            duration = time.time() - start
+            metrics.observe("terrariumpi_db_transaction_seconds", duration, transaction="history_write")
+            with self.__lock:
+                self.__stats["flushes"] += 1
+                self.__stats["rows"] += len(items) - errors
+                self.__stats["errors"] += errors
+                self.__stats["last_duration"] = duration
+                self.__stats["max_duration"] = max(self.__stats["max_duration"], duration)
+                self.__stats["total_duration"] += duration
+
+            logger.debug(f"Written {len(items) - errors} history rows in {duration:.2f} seconds.")
+            return len(items) - errors
+
+
+history_writer = terrariumHistoryWriter()
+
+
+class terrariumHistoryPartitions(terrariumSingleton):
+    """
+    The raw sensor history of previous months is moved out of the main database into a partition file per month.
+    A partition is only attached when a query needs data of that month, and old partitions are removed by deleting the
+    file. The main database only holds the current month, which keeps it small for backups and recovery. The history
+    is only moved when a retention for the minute history is set.
+    """
+
+    __ARCHIVE_DELAY = 2  # Days after the end of a month before it is moved to its partition
+    __BATCH_SIZE = 2000  # Amount of rows to move per transaction
+
+    # The oldest raw sensor history, with a lookup on the primary key per sensor
+    __OLDEST = """SELECT MIN((SELECT MIN("timestamp") FROM "main"."SensorHistory" WHERE "sensor" = "Sensor"."id"))
+                  FROM "main"."Sensor\""""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __next_month(month):
+        return (month.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+    @staticmethod
+    def __connect(partition=None):
+        # Attaching is not possible inside a transaction, so use a separate connection in autocommit mode.
+        # A streamed query can continue in another database thread, see terrariumDatabaseExecutor.stream
+        connection = sqlite3.connect(DATABASE, isolation_level=None, check_same_thread=False)
+        if partition is not None:
+            connection.execute("ATTACH DATABASE ? AS \"partition\"", (str(partition),))
+            connection.executescript(
+                """CREATE TABLE IF NOT EXISTS "partition"."SensorHistory" (
+                     "sensor" TEXT NOT NULL,
+                     "timestamp" DATETIME NOT NULL,
+                     "value" REAL NOT NULL,
+                     "samples" INTEGER NOT NULL DEFAULT 1,
+                     PRIMARY KEY("sensor","timestamp")
+                   ) WITHOUT ROWID;"""
+            )
+
+        return connection
+
+    @property
+    def partitions(self):
+        partitions = []
+        for partition in sorted(Path(HISTORY_PARTITIONS).glob("sensorhistory_*.db")):
+            try:
+                partitions.append((datetime.strptime(partition.stem, "sensorhistory_%Y_%m"), partition))
+            except ValueError:
+                continue
+
+        return partitions
+
+    def partition(self, month):
+        return Path(HISTORY_PARTITIONS) / f"sensorhistory_{month:%Y_%m}.db"
+
+    def archive(self, deadline):
+        """
+        Move the raw sensor history of previous months to the monthly partitions till the deadline is reached.
+
+        Returns the amount of moved rows per month.
+        """
+        archive_before = (datetime.now() - timedelta(days=terrariumHistoryPartitions.__ARCHIVE_DELAY)).replace(
+            day=1, hour=0, minute=0, second=0, microsecond=0
+        )
+        archive_before = f"{archive_before:%Y-%m-%d %H:%M:%S}"
+        moved = {}
+
+        with self.__lock:
+            connection = terrariumHistoryPartitions.__connect()
+            try:
+                # There is no index on the timestamp, so all the sensors are moved together per time window with the
+                # primary key. A timestamp is then never split between a partition and the main database.
+                sensors = connection.execute('SELECT COUNT(*) FROM "Sensor"').fetchone()[0]
+                window = timedelta(minutes=max(1, terrariumHistoryPartitions.__BATCH_SIZE // max(1, sensors)))
+
+                while time.time() < deadline:
+                    oldest = connection.execute(terrariumHistoryPartitions.__OLDEST).fetchone()[0]
+                    if oldest is None or oldest >= archive_before:
+                        break
+
+                    month = datetime.fromisoformat(oldest).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+                    next_month = terrariumHistoryPartitions.__next_month(month)
+
+                    Path(HISTORY_PARTITIONS).mkdir(parents=True, exist_ok=True)
+                    connection.close()
+                    connection = terrariumHistoryPartitions.__connect(self.partition(month))
+
+                    while time.time() < deadline:
+                        oldest = connection.execute(terrariumHistoryPartitions.__OLDEST).fetchone()[0]
+                        if oldest is None or datetime.fromisoformat(oldest) >= next_month:
+                            break
+
+                        # Move all rows of all sensors up to the end of the window
+                        bound = min(datetime.fromisoformat(oldest) + window, next_month)
+                        parameters = (f"{bound:%Y-%m-%d %H:%M:%S.%f}",)
+                        period = '"sensor" IN (SELECT "id" FROM "main"."Sensor") AND "timestamp" < ?'
+
+                        connection.execute("BEGIN IMMEDIATE")
+                        try:
+                            rows = connection.execute(
+                                f"""INSERT OR REPLACE INTO "partition"."SensorHistory" ("sensor", "timestamp", "value", "samples")
+                                    SELECT "sensor", "timestamp", "value", "samples" FROM "main"."SensorHistory" WHERE {period}""",
+                                parameters,
+                            ).rowcount
+                            connection.execute(f'DELETE FROM "main"."SensorHistory" WHERE {period}', parameters)
+                            connection.execute("COMMIT")
+                        except Exception:
+                            connection.execute("ROLLBACK")
+                            raise
+
+                        moved[f"{month:%Y-%m}"] = moved.get(f"{month:%Y-%m}", 0) + rows
+                        # Give the web server and the engine a turn between the batches. A sleep of zero would only
+                        # switch to the ready greenlets, without handling the sockets and timers of the event loop
+                        sleep(HUB_PAUSE)
+
+                    connection.execute('DETACH DATABASE "partition"')
+
+            finally:
+                connection.close()
+
+        if len(moved) > 0:
+            logger.info(f"Moved sensor history to the monthly partitions: {moved}")
+
+        return moved
+
+    def remove(self, before):
+        """
+        Remove all the partitions that only contain history from before the given date.
+        """
+        removed = []
+        with self.__lock:
+            for month, partition in self.partitions:
+                if terrariumHistoryPartitions.__next_month(month) <= before:
+                    partition.unlink()
+                    removed.append(f"{month:%Y-%m}")
+
+        if len(removed) > 0:
+            logger.info(f"Removed sensor history partitions: {', '.join(removed)}")
+
+        return removed
+
+    def delete_sensor(self, sensor):
+        with self.__lock:
+            for _, partition in self.partitions:
+                connection = terrariumHistoryPartitions.__connect(partition)
+                try:
+                    connection.execute('DELETE FROM "partition"."SensorHistory" WHERE "sensor" = ?', (sensor,))
+                finally:
+                    connection.close()
+
+    def __query(self, partition, query, parameters):
+        connection = terrariumHistoryPartitions.__connect(partition)
+        try:
+            yield from stream_query(query('"partition"."SensorHistory"'), parameters, connection)
+        finally:
+            connection.close()
+
+    def history(self, query, start, end=None, parameters=(), key=None):
+        """
+        Yield the rows of a raw sensor history query from every partition that overlaps with the period, oldest month
+        first. The query is a function that returns the SQL for the given history table. The start and end of the period
+        in the partition are added as the last two parameters. Tables of the main database, like the limits, can be joined.
+
+        With a key, the ordered rows of all the partitions are merged on that key instead of read one month after the other.
+        """
+        partitions = []
+        for month, partition in self.partitions:
+            next_month = terrariumHistoryPartitions.__next_month(month)
+            if next_month <= start or (end is not None and month >= end):
+                continue
+
+            partitions.append(
+                self.__query(
+                    partition,
+                    query,
+                    (
+                        *parameters,
+                        f"{start:%Y-%m-%d %H:%M:%S.%f}",
+                        f"{next_month if end is None else min(end, next_month):%Y-%m-%d %H:%M:%S.%f}",
+                    ),
+                )
+            )
+
+        if key is None:
+            for rows in partitions:
+                yield from rows
+        else:
+            yield from heapq.merge(*partitions, key=key)
+
+
+history_partitions = terrariumHistoryPartitions()
+
+
+class terrariumHistoryCleanup(terrariumSingleton):
+    """
+    Retention policy for the history data. Old history rows are deleted in small batches during the idle time of the
+    engine loop, with a short pause for the gevent hub between the batches, so the database size is bounded without
+    stopping TerrariumPI. Sensor history of previous months is
+    moved to the monthly partitions, and old partitions are removed. Once a day the freed pages are given back, the
+    query planner statistics are updated and the WAL file is truncated.
+    """
+
+    __BATCH_SIZE = 500  # Amount of rows to delete per transaction
+    __MAINTENANCE_INTERVAL = 24 * 60 * 60  # Run database maintenance every x seconds
+    __VACUUM_PAGES = 2000  # Max amount of free pages to give back per maintenance run
+    __VACUUM_STEP = 100  # Amount of free pages to give back before giving the gevent hub a turn
+
+    # History tables with the device key column and the device table, grouped by retention type
+    __TABLES = {
+        "minute": [
+            ("SensorHistory", "sensor", "Sensor"),
+            ("RelayHistory", "relay", "Relay"),
+            ("ButtonHistory", "button", "Button"),
+        ],
+        "hourly": [("SensorHistoryHourly", "sensor", "Sensor")],
+        "daily": [("SensorHistoryDaily", "sensor", "Sensor")],
+    }
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # Retention in days per retention type. Zero will keep the history forever
+        self.__retention = {"minute": 0, "hourly": 0, "daily": 0}
+        self.__last_maintenance = time.time()
+
+        self.__stats = {
+            "deleted": 0,
+            "runs": 0,
+            "last_run": None,
+            "last_maintenance": None,
+        }
+
+    @property
+    def stats(self):
+        with self.__lock:
+            stats = copy.copy(self.__stats)
+            stats["retention"] = copy.copy(self.__retention)
+
+        return stats
+
+    def set_retention(self, minute=0, hourly=0, daily=0):
+        with self.__lock:
+            self.__retention = {"minute": max(0, minute), "hourly": max(0, hourly), "daily": max(0, daily)}
+
+    def __delete_batch(self, table, key, device, limit):
+        # There is no index on the timestamp, so delete per device with the primary key
+        with metrics.timer("terrariumpi_db_transaction_seconds", transaction="history_cleanup"), orm.db_session():
+            batch = terrariumHistoryCleanup.__BATCH_SIZE
+            return db.execute(
+                f"""DELETE FROM "{table}" WHERE "{key}" = $device AND "timestamp" IN (
+                      SELECT "timestamp" FROM "{table}" WHERE "{key}" = $device AND "timestamp" < $limit LIMIT $batch
+                    )"""
+            ).rowcount
+
+    def maintenance(self):
+        start = time.time()
+        # The WAL checkpoint can not run inside a transaction, so use a separate connection in autocommit mode
+        connection = sqlite3.connect(DATABASE, isolation_level=None)
+        try:
+            # Only gives space back when the database is created with auto_vacuum incremental.
+            # A normal execute will only free a single page, executescript runs the vacuum till the end.
+            # The pages are given back in small steps with a pause, so the gevent hub is not blocked
+            for _ in range(terrariumHistoryCleanup.__VACUUM_PAGES // terrariumHistoryCleanup.__VACUUM_STEP):
+                if connection.execute("PRAGMA freelist_count").fetchone()[0] == 0:
+                    break
+
+                connection.executescript(f"PRAGMA incremental_vacuum({terrariumHistoryCleanup.__VACUUM_STEP});")
+                sleep(HUB_PAUSE)
+
+            connection.execute("PRAGMA optimize").fetchall()
+            sleep(HUB_PAUSE)
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        finally:
+            connection.close()
+
+        self.__last_maintenance = time.time()
+        with self.__lock:
+            self.__stats["last_maintenance"] = time.time()
+
+        logger.info(f"Database maintenance done in {time.time()-start:.2f} seconds.")
+
+    def run(self, deadline):
+        """
+        Delete old history rows till there is no more old data or when the deadline is reached.
+
+        Returns the progress, or None when there was nothing to do.
+        """
+        with self.__lock:
+            retention = copy.copy(self.__retention)
+
+        start = time.time()
+        progress = {"deleted": {}, "archived": {}, "partitions": [], "done": True, "maintenance": False}
+        for retention_type, days in retention.items():
+            if days <= 0:
+                continue
+
+            limit = datetime.now() - timedelta(days=days)
+            if "minute" == retention_type:
+                try:
+                    progress["partitions"] = history_partitions.remove(limit)
+                except Exception as ex:
+                    logger.error(f"Error removing old sensor history partitions: {ex}")
+
+            limit = f"{limit:%Y-%m-%d %H:%M:%S}"
+            for table, key, devices in terrariumHistoryCleanup.__TABLES[retention_type]:
+                with orm.db_session():
+                    devices = db.select(f'SELECT "id" FROM "{devices}" ORDER BY "id"')
+
+                for device in devices:
+                    while True:
+                        if time.time() >= deadline:
+                            progress["done"] = False
+                            break
+
+                        try:
+                            deleted = self.__delete_batch(table, key, device, limit)
+                        except Exception as ex:
+                            logger.error(f"Error cleaning up history table {table}: {ex}")
+                            break
+
+                        if deleted > 0:
+                            progress["deleted"][table] = progress["deleted"].get(table, 0) + deleted
+
+                        # Give the web server and the engine a turn between the batches. A sleep of zero would only
+                        # switch to the ready greenlets, without handling the sockets and timers of the event loop
+                        sleep(HUB_PAUSE)
+                        if deleted < terrariumHistoryCleanup.__BATCH_SIZE:
+                            break
+
+                    if not progress["done"]:
+                        break
+
+        # Only move the history to the partitions when the minute history has a retention. With the default of keeping
+        # everything, the history stays in the main database
+        if retention["minute"] > 0 and time.time() < deadline:
+            try:
+                progress["archived"] = history_partitions.archive(deadline)
+            except Exception as ex:
+                logger.error(f"Error moving sensor history to the monthly partitions: {ex}")
+
+        if (
+            progress["done"]
+            and time.time() < deadline
+            and time.time() - self.__last_maintenance >= terrariumHistoryCleanup.__MAINTENANCE_INTERVAL
+        ):
+            try:
+                self.maintenance()
+                progress["maintenance"] = True
+            except Exception as ex:
+                logger.error(f"Error running database maintenance: {ex}")
+
+        if (
+            len(progress["deleted"]) == 0
+            and len(progress["archived"]) == 0
+            and len(progress["partitions"]) == 0
+            and not progress["maintenance"]
+        ):
+            return None
+
+        deleted = sum(progress["deleted"].values())
+        progress["duration"] = time.time() - start
+        with self.__lock:
+            self.__stats["deleted"] += deleted
+            self.__stats["runs"] += 1
+            self.__stats["last_run"] = time.time()
+
+        logger.info(
+            f"Cleaned up {deleted} old history rows in {progress['duration']:.2f} seconds. {'Done' if progress['done'] else 'Continuing in the next round'}."
+        )
+        return progress
+
+
+history_cleanup = terrariumHistoryCleanup()
+
+
+class terrariumDatabaseExecutor(terrariumSingleton):
+    """
+    Runs heavy read queries in a small pool of OS threads. The sqlite3 calls are not cooperative, so a long query in the
+    gevent hub blocks the web server, the websockets and the engine until it is done. Every thread has its own read only
+    database connection, so the readers never take the write lock. A monitor greenlet measures how late the hub is, so
+    we can see when and how long it was blocked. When the executor is not started, the queries run directly.
+    """
+
+    __MONITOR_INTERVAL = 0.25  # Check every x seconds if the hub is running late
+    __BLOCKED_THRESHOLD = 0.1  # The hub is blocked when it is more than x seconds late
+
+    def __init__(self):
+        self.__pool = None
+        self.__monitor = None
+        self.__concurrency = 2
+        self.__thread = threading.local()
+
+        self.__stats = {
+            "tasks": 0,
+            "errors": 0,
+            "last_duration": 0.0,
+            "max_duration": 0.0,
+            "total_duration": 0.0,
+            "hub_blocked": 0,
+            "hub_last_blocked": 0.0,
+            "hub_max_blocked": 0.0,
+            "hub_total_blocked": 0.0,
+        }
+
+    def __hub_monitor(self):
+        while self.__pool is not None:
+            start = time.perf_counter()
+            sleep(terrariumDatabaseExecutor.__MONITOR_INTERVAL)
+            late = time.perf_counter() - start - terrariumDatabaseExecutor.__MONITOR_INTERVAL
+
+            if late > terrariumDatabaseExecutor.__BLOCKED_THRESHOLD:
+                self.__stats["hub_blocked"] += 1
+                self.__stats["hub_last_blocked"] = late
+                self.__stats["hub_max_blocked"] = max(self.__stats["hub_max_blocked"], late)
+                self.__stats["hub_total_blocked"] += late
+                logger.debug(f"The gevent hub was blocked for {late:.2f} seconds.")
+
+    @property
+    def running(self):
+        return self.__pool is not None
+
+    @property
+    def reader(self):
+        # True when running in one of the database threads
+        return getattr(self.__thread, "reader", False)
+
+    @property
+    def stats(self):
+        stats = copy.copy(self.__stats)
+        stats["concurrency"] = self.__concurrency
+        stats["queue_depth"] = 0 if self.__pool is None else len(self.__pool)
+        stats["average_duration"] = 0.0 if stats["tasks"] == 0 else stats["total_duration"] / stats["tasks"]
+        return stats
+
+    def set_concurrency(self, concurrency):
+        self.__concurrency = max(1, int(concurrency))
+        if self.__pool is not None:
+            self.__pool.maxsize = self.__concurrency
+
+    def start(self):
+        if self.__pool is not None:
+            return
+
+        logger.info(f"Starting database executor with {self.__concurrency} threads.")
+        self.__pool = ThreadPool(self.__concurrency)
+        self.__monitor = spawn(self.__hub_monitor)
+
+    def stop(self):
+        if self.__pool is None:
+            return
+
+        pool, self.__pool = self.__pool, None
+        self.__monitor.kill()
+        self.__monitor = None
+        pool.join()
+        pool.kill()
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run the function in one of the database threads and wait for the result, without blocking the hub. The function
+        should open its own db_session, as the db_session of the caller is not available in the database thread.
+        """
+        if self.__pool is None or self.reader:
+            return func(*args, **kwargs)
+
+        def task():
+            self.__thread.reader = True
+            # Return the exception to the caller, else gevent will also print it as an unhandled error
+            try:
+                return func(*args, **kwargs), None
+            except Exception as ex:
+                return None, ex
+
+        start = time.time()
+        result, error = self.__pool.apply(task)
+        duration = time.time() - start
+        metrics.observe("terrariumpi_db_transaction_seconds", duration, transaction="query")
+
+        self.__stats["tasks"] += 1
+        self.__stats["last_duration"] = duration
+        self.__stats["max_duration"] = max(self.__stats["max_duration"], duration)
+        self.__stats["total_duration"] += duration
+
+        if error is not None:
+            self.__stats["errors"] += 1
+            raise error
+
+        return result
+
+    def stream(self, items):
+        """
+        Yield the items of a streamed response, like a CSV export, while every item is made in one of the database
+        threads. The next item is only asked for when the previous one is done, so the database connection of a
+        streamed query is never used by two threads at the same time.
+        """
+        items = iter(items)
+        if self.__pool is None or self.reader:
+            yield from items
+            return
+
+        done = object()
+        while True:
+            item = self.run(next, items, done)
+            if item is done:
+                break
+
+            yield item
+
+
+db_executor = terrariumDatabaseExecutor()
+
+
+def stream_query(sql, parameters=(), connection=None):
+    """
+    Yield the rows of a read only query in small batches from the cursor, so large results never have to fit in memory.
+    Without a connection, a separate read only connection is used that is closed when all rows are read.
+    """
+    close = connection is None
+    if close:
+        # A streamed query can continue in another database thread, see terrariumDatabaseExecutor.stream
+        connection = sqlite3.connect(DATABASE, check_same_thread=False)
+        connection.execute("PRAGMA query_only = ON")
+
+    try:
+        cursor = connection.execute(sql, parameters)
+        while True:
+            rows = cursor.fetchmany(500)
+            if not rows:
+                break
+
+            yield from rows
+    finally:
+        if close:
+            connection.close()
+
+
 def recover():
     starttime = time.time()
 
@@ -176,16 +932,15 @@ class Button(db.Entity):
 
     @property
     def value(self):
-        timestamp_limit = datetime.now() - timedelta(seconds=Button.__MAX_VALUE_AGE)
-        value = (
-            self.history.filter(lambda h: h.timestamp >= timestamp_limit)
-            .order_by(orm.desc(ButtonHistory.timestamp))
-            .first()
-        )
-        if value:
-            return value.value
+        known, value = latest_values.get("button", self.id, Button.__MAX_VALUE_AGE)
+        if known:
+            return value
+
+        # Cold start: load the last known value from the database once
+        value = self.history.order_by(orm.desc(ButtonHistory.timestamp)).first()
+        latest_values.set("button", self.id, value.timestamp if value else None, value.value if value else None)
 
-        return None
+        return latest_values.get("button", self.id, Button.__MAX_VALUE_AGE)[1]
 
     @property
     def error(self):
@@ -196,9 +951,10 @@ class Button(db.Entity):
             return
 
         if force or new_value != self.value:
-            button_data = ButtonHistory(button=self, timestamp=datetime.now(), value=new_value)
+            timestamp = datetime.now()
+            latest_values.set("button", self.id, timestamp, new_value)
 
-            return button_data
+            return history_writer.add(ButtonHistory, button=self.id, timestamp=timestamp, value=new_value)
 
     def to_dict(self, only=None, exclude=None, with_collections=False, with_lazy=False, related_objects=False):
         data = copy.deepcopy(super().to_dict(only, exclude, with_collections, with_lazy, related_objects))
@@ -219,6 +975,53 @@ class ButtonHistory(db.Entity):
 
     orm.PrimaryKey(button, timestamp)
 
+    @classmethod
+    def export(cls, button, start, end=datetime.max):
+        return stream_query(
+            'SELECT "timestamp", "value" FROM "ButtonHistory" WHERE "button" = ? AND "timestamp" >= ? AND "timestamp" < ? ORDER BY "timestamp" ASC',
+            (button, f"{start:%Y-%m-%d %H:%M:%S.%f}", f"{end:%Y-%m-%d %H:%M:%S.%f}"),
+        )
+
+    @classmethod
+    def changes(cls, button, start, end=datetime.max):
+        # Only the history rows where the value has changed, and the last row for the current state
+        start = f"{start:%Y-%m-%d %H:%M:%S.%f}"
+        end = f"{end:%Y-%m-%d %H:%M:%S.%f}"
+        return cls.select_by_sql(
+            """SELECT "button", "timestamp", "value" FROM (
+                 SELECT "button", "timestamp", "value",
+                   LAG("value") OVER (ORDER BY "timestamp") AS "previous",
+                   LEAD("value") OVER (ORDER BY "timestamp") AS "next"
+                 FROM "ButtonHistory" WHERE "button" = $button AND "timestamp" >= $start AND "timestamp" < $end)
+               WHERE "previous" IS NULL OR "next" IS NULL OR "previous" != "value"
+               ORDER BY "timestamp" ASC"""
+        )
+
+    @classmethod
+    def bulk(cls, buttons, start, end=datetime.max, changes=False):
+        # The history of multiple buttons in one query, ordered by button. With changes, only the rows where the value has changed
+        placeholders = ", ".join(["?"] * len(buttons))
+        parameters = (*buttons, f"{start:%Y-%m-%d %H:%M:%S.%f}", f"{end:%Y-%m-%d %H:%M:%S.%f}")
+        if not changes:
+            return stream_query(
+                f"""SELECT "button", "timestamp", "value" FROM "ButtonHistory"
+                    WHERE "button" IN ({placeholders}) AND "timestamp" >= ? AND "timestamp" < ?
+                    ORDER BY "button" ASC, "timestamp" ASC""",
+                parameters,
+            )
+
+        return stream_query(
+            f"""SELECT "button", "timestamp", "value" FROM (
+                 SELECT "button", "timestamp", "value",
+                   LAG("value") OVER "history" AS "previous",
+                   LEAD("value") OVER "history" AS "next"
+                 FROM "ButtonHistory" WHERE "button" IN ({placeholders}) AND "timestamp" >= ? AND "timestamp" < ?
+                 WINDOW "history" AS (PARTITION BY "button" ORDER BY "timestamp"))
+               WHERE "previous" IS NULL OR "next" IS NULL OR "previous" != "value"
+               ORDER BY "button" ASC, "timestamp" ASC""",
+            parameters,
+        )
+
 
 class Enclosure(db.Entity):
     id = orm.PrimaryKey(str, default=terrariumUtils.generate_uuid)
@@ -342,20 +1145,21 @@ class Relay(db.Entity):
     calibration = orm.Optional(orm.Json)
 
     history = orm.Set("RelayHistory")
+    usage = orm.Optional("RelayUsage", cascade_delete=True)
 
     webcam = orm.Optional(lambda: Webcam)
 
     @property
     def value(self):
-        value = (
-            self.history.filter(lambda h: h.timestamp >= datetime.now() - timedelta(seconds=Relay.__MAX_VALUE_AGE))
-            .order_by(orm.desc(RelayHistory.timestamp))
-            .first()
-        )
-        if value:
-            return value.value
+        known, value = latest_values.get("relay", self.id, Relay.__MAX_VALUE_AGE)
+        if known:
+            return value
+
+        # Cold start: load the last known value from the database once
+        value = self.history.order_by(orm.desc(RelayHistory.timestamp)).first()
+        latest_values.set("relay", self.id, value.timestamp if value else None, value.value if value else None)
 
-        return None
+        return latest_values.get("relay", self.id, Relay.__MAX_VALUE_AGE)[1]
 
     @property
     def error(self):
@@ -407,16 +1211,18 @@ class Relay(db.Entity):
             return None
 
         if force or new_value != self.value:
-            relay_data = RelayHistory(
-                relay=self,
-                timestamp=datetime.now(),
+            timestamp = datetime.now()
+            latest_values.set("relay", self.id, timestamp, new_value)
+
+            return history_writer.add(
+                RelayHistory.store,
+                relay=self.id,
+                timestamp=timestamp,
                 value=new_value,
                 wattage=(new_value / 100.0) * self.wattage,
                 flow=(new_value / 100.0) * self.flow,
             )
 
-            return relay_data
-
     def __repr__(self):
         return f"{self.hardware} {self.type} named '{self.name}' at address '{self.address}'"
 
@@ -430,10 +1236,113 @@ class RelayHistory(db.Entity):
 
     orm.PrimaryKey(relay, timestamp)
 
+    @classmethod
+    def store(cls, relay, timestamp, value, wattage, flow):
+        relay_data = cls(relay=relay, timestamp=timestamp, value=value, wattage=wattage, flow=flow)
+
+        # Keep the power and water usage totals up to date
+        usage = RelayUsage.get(relay=relay)
+        if usage is None:
+            RelayUsage(
+                relay=relay,
+                timestamp=timestamp,
+                value=value,
+                wattage=wattage,
+                flow=flow,
+                period_start=timestamp if value > 0 else None,
+            )
+        else:
+            usage.add(timestamp, value, wattage, flow)
+
+        return relay_data
+
+    @classmethod
+    def export(cls, relay, start, end=datetime.max):
+        return stream_query(
+            'SELECT "timestamp", "value", "wattage", "flow" FROM "RelayHistory" WHERE "relay" = ? AND "timestamp" >= ? AND "timestamp" < ? ORDER BY "timestamp" ASC',
+            (relay, f"{start:%Y-%m-%d %H:%M:%S.%f}", f"{end:%Y-%m-%d %H:%M:%S.%f}"),
+        )
+
+    @classmethod
+    def changes(cls, relay, start, end=datetime.max):
+        # Only the history rows where the value has changed, and the last row for the current state
+        start = f"{start:%Y-%m-%d %H:%M:%S.%f}"
+        end = f"{end:%Y-%m-%d %H:%M:%S.%f}"
+        return cls.select_by_sql(
+            """SELECT "relay", "timestamp", "value", "wattage", "flow" FROM (
+                 SELECT "relay", "timestamp", "value", "wattage", "flow",
+                   LAG("value") OVER (ORDER BY "timestamp") AS "previous",
+                   LEAD("value") OVER (ORDER BY "timestamp") AS "next"
+                 FROM "RelayHistory" WHERE "relay" = $relay AND "timestamp" >= $start AND "timestamp" < $end)
+               WHERE "previous" IS NULL OR "next" IS NULL OR "previous" != "value"
+               ORDER BY "timestamp" ASC"""
+        )
+
+    @classmethod
+    def bulk(cls, relays, start, end=datetime.max, changes=False):
+        # The history of multiple relays in one query, ordered by relay. With changes, only the rows where the value has changed
+        placeholders = ", ".join(["?"] * len(relays))
+        parameters = (*relays, f"{start:%Y-%m-%d %H:%M:%S.%f}", f"{end:%Y-%m-%d %H:%M:%S.%f}")
+        if not changes:
+            return stream_query(
+                f"""SELECT "relay", "timestamp", "value", "wattage", "flow" FROM "RelayHistory"
+                    WHERE "relay" IN ({placeholders}) AND "timestamp" >= ? AND "timestamp" < ?
+                    ORDER BY "relay" ASC, "timestamp" ASC""",
+                parameters,
+            )
+
+        return stream_query(
+            f"""SELECT "relay", "timestamp", "value", "wattage", "flow" FROM (
+                 SELECT "relay", "timestamp", "value", "wattage", "flow",
+                   LAG("value") OVER "history" AS "previous",
+                   LEAD("value") OVER "history" AS "next"
+                 FROM "RelayHistory" WHERE "relay" IN ({placeholders}) AND "timestamp" >= ? AND "timestamp" < ?
+                 WINDOW "history" AS (PARTITION BY "relay" ORDER BY "timestamp"))
+               WHERE "previous" IS NULL OR "next" IS NULL OR "previous" != "value"
+               ORDER BY "relay" ASC, "timestamp" ASC""",
+            parameters,
+        )
+
+
+class RelayUsage(db.Entity):
+    relay = orm.PrimaryKey("Relay")
+
+    # The last relay history entry
+    timestamp = orm.Required(datetime)
+    value = orm.Required(float)
+    wattage = orm.Required(float)
+    flow = orm.Required(float)
+
+    total_wattage = orm.Required(float, default=0)  # In watt-seconds
+    total_flow = orm.Required(float, default=0)  # In liters
+    duration = orm.Required(float, default=0)  # Total on time in seconds
+
+    # First and last moment the relay was on
+    period_start = orm.Optional(datetime)
+    period_end = orm.Optional(datetime)
+
+    def add(self, timestamp, value, wattage, flow):
+        # Close the previous period when the relay was on
+        if self.value > 0:
+            duration = (timestamp - self.timestamp).total_seconds()
+            self.total_wattage += duration * self.wattage
+            self.total_flow += (duration / 60.0) * self.flow
+            self.duration += duration
+            self.period_end = timestamp
+
+        if value > 0 and self.period_start is None:
+            self.period_start = timestamp
+
+        self.timestamp = timestamp
+        self.value = value
+        self.wattage = wattage
+        self.flow = flow
+
 
 class Sensor(db.Entity):
     __MAX_VALUE_AGE = 5 * 60  # Max age of the last measurement in minutes
     __VALUE_MODE = 2  # Mode 1: Only store first value. Mode 2: Store average value. Mode 3: Store last value.
+    __MINUTE_BUCKETS = {}  # The current minute bucket per sensor: (timestamp, samples, value)
 
     id = orm.PrimaryKey(str)
     hardware = orm.Required(str)
@@ -452,6 +1361,9 @@ class Sensor(db.Entity):
     calibration = orm.Optional(orm.Json)
 
     history = orm.Set("SensorHistory")
+    history_limits = orm.Set("SensorHistoryLimits")
+    history_hourly = orm.Set("SensorHistoryHourly")
+    history_daily = orm.Set("SensorHistoryDaily")
 
     @property
     def offset(self):
@@ -469,15 +1381,15 @@ class Sensor(db.Entity):
 
     @property
     def value(self):
-        value = (
-            self.history.filter(lambda h: h.timestamp >= datetime.now() - timedelta(seconds=Sensor.__MAX_VALUE_AGE))
-            .order_by(orm.desc(SensorHistory.timestamp))
-            .first()
-        )
-        if value:
-            return value.value
+        known, value = latest_values.get("sensor", self.id, Sensor.__MAX_VALUE_AGE)
+        if known:
+            return value
+
+        # Cold start: load the last known value from the database once
+        value = self.history.order_by(orm.desc(SensorHistory.timestamp)).first()
+        latest_values.set("sensor", self.id, value.timestamp if value else None, value.value if value else None)
 
-        return None
+        return latest_values.get("sensor", self.id, Sensor.__MAX_VALUE_AGE)[1]
 
     @property
     def error(self):
@@ -497,72 +1409,368 @@ class Sensor(db.Entity):
         if value is None:
             return
 
-        # TODO: Make some insert or update construction. Now we have always 2 queries per update, should be nice to reduce to one.
         timestamp = datetime.now().replace(second=0, microsecond=0)
-        sensor_data = self.history.filter(lambda h: h.timestamp == timestamp).first()
 
-        # We have already a value measured for this minute, so we are done!
-        if sensor_data and self.__VALUE_MODE == 1:
-            return sensor_data
+        # Keep track of the current minute bucket, so the latest value store has the same value as the database
+        bucket = Sensor.__MINUTE_BUCKETS.get(self.id)
+        if bucket is None or bucket[0] != timestamp:
+            bucket = (timestamp, 1, value)
+        elif self.__VALUE_MODE == 2:
+            bucket = (timestamp, bucket[1] + 1, (bucket[2] * bucket[1] + value) / (bucket[1] + 1))
+        elif self.__VALUE_MODE == 3:
+            bucket = (timestamp, bucket[1] + 1, value)
+
+        Sensor.__MINUTE_BUCKETS[self.id] = bucket
+        latest_values.set("sensor", self.id, timestamp, bucket[2])
+
+        return history_writer.add(
+            SensorHistory.merge,
+            sensor=self.id,
+            timestamp=timestamp,
+            value=value,
+            limit_min=self.limit_min,
+            limit_max=self.limit_max,
+            alarm_min=self.alarm_min,
+            alarm_max=self.alarm_max,
+            exclude_avg=self.exclude_avg,
+            mode=self.__VALUE_MODE,
+        )
 
-        if sensor_data:
-            # Mode 2 will take previous value and current and average it.
-            # Mode 3 will just overwrite existing value
+    def __repr__(self):
+        return f"{self.hardware} {self.type} named '{self.name}' at address '{self.address}'"
 
-            sensor_data.value = value if self.__VALUE_MODE == 3 else (sensor_data.value + value) / 2
-            sensor_data.limit_min = (
-                self.limit_min if self.__VALUE_MODE == 3 else (sensor_data.limit_min + self.limit_min) / 2
+
+class SensorHistory(db.Entity):
+    sensor = orm.Required("Sensor")
+
+    timestamp = orm.Required(datetime)
+    value = orm.Required(float)
+
+    samples = orm.Required(int, default=1)
+
+    orm.PrimaryKey(sensor, timestamp)
+
+    # The sensors and hours of which the rollups need to be recalculated with the next history flush
+    __pending_rollups = set()
+
+    # The limits and alarm values are stored in SensorHistoryLimits when changed. Every change is valid until the next
+    # change, so the changes are joined once as intervals instead of looking up the active change per history row.
+    LIMITS_JOIN = """JOIN (
+        SELECT "sensor", "limit_min", "limit_max", "alarm_min", "alarm_max", "exclude_avg", "timestamp" AS "valid_from",
+          LEAD("timestamp", 1, '9999-12-31') OVER (PARTITION BY "sensor" ORDER BY "timestamp") AS "valid_to"
+        FROM "SensorHistoryLimits"
+    ) AS "sl" ON "sl"."sensor" = "sh"."sensor" AND "sh"."timestamp" >= "sl"."valid_from" AND "sh"."timestamp" < "sl"."valid_to\""""
+
+    __ROLLUP_FIELDS = ", ".join(
+        [
+            f'"{field}"'
+            for field in [
+                "sensor",
+                "timestamp",
+                "value",
+                "value_min",
+                "value_max",
+                "limit_min",
+                "limit_max",
+                "alarm_min",
+                "alarm_max",
+                "exclude_avg",
+                "samples",
+            ]
+        ]
+    )
+    __ROLLUP_UPDATE = ", ".join(
+        [
+            f'"{field}" = excluded."{field}"'
+            for field in [
+                "value",
+                "value_min",
+                "value_max",
+                "limit_min",
+                "limit_max",
+                "alarm_min",
+                "alarm_max",
+                "exclude_avg",
+                "samples",
+            ]
+        ]
+    )
+
+    @classmethod
+    def merge(cls, sensor, timestamp, value, limit_min, limit_max, alarm_min, alarm_max, exclude_avg, mode=2):
+        # Insert or update the minute bucket in a single query.
+        # Mode 1 will keep the first value, mode 2 will store the mean of all samples and mode 3 will store the last value.
+        if 1 == mode:
+            update = "NOTHING"
+        elif 2 == mode:
+            update = 'UPDATE SET "value" = ("value" * "samples" + excluded."value") / ("samples" + 1), "samples" = "samples" + 1'
+        else:
+            update = 'UPDATE SET "value" = excluded."value", "samples" = "samples" + 1'
+
+        # Use the same timestamp format as Pony, so the conflict also matches the existing rows
+        minute = f"{timestamp.replace(second=0, microsecond=0):%Y-%m-%d %H:%M:%S.%f}"
+        exclude_avg = 1 if exclude_avg else 0
+        db.execute(
+            f"""INSERT INTO "SensorHistory" ("sensor", "timestamp", "value", "samples")
+                VALUES ($sensor, $minute, $value, 1)
+                ON CONFLICT ("sensor", "timestamp") DO {update}"""
+        )
+
+        # Only store the limits and alarm values when they are changed
+        db.execute(
+            """INSERT INTO "SensorHistoryLimits" ("sensor", "timestamp", "limit_min", "limit_max", "alarm_min", "alarm_max", "exclude_avg")
+                SELECT $sensor, $minute, $limit_min, $limit_max, $alarm_min, $alarm_max, $exclude_avg
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM (
+                        SELECT * FROM "SensorHistoryLimits" WHERE "sensor" = $sensor ORDER BY "timestamp" DESC LIMIT 1
+                    ) AS "current"
+                    WHERE "current"."limit_min" = $limit_min AND "current"."limit_max" = $limit_max
+                      AND "current"."alarm_min" = $alarm_min AND "current"."alarm_max" = $alarm_max
+                      AND "current"."exclude_avg" = $exclude_avg
+                )
+                ON CONFLICT ("sensor", "timestamp") DO UPDATE SET
+                  "limit_min" = excluded."limit_min", "limit_max" = excluded."limit_max",
+                  "alarm_min" = excluded."alarm_min", "alarm_max" = excluded."alarm_max",
+                  "exclude_avg" = excluded."exclude_avg"
+            """
+        )
+
+        # The rollups of this hour are recalculated once at the end of the history flush
+        cls.__pending_rollups.add((sensor, timestamp.replace(minute=0, second=0, microsecond=0)))
+
+    @classmethod
+    def update_rollups(cls):
+        """
+        Recalculate the hourly rollups from the minute buckets, and the daily rollups from the hourly rollups, of all
+        the sensors that got new history data. This is one query per hour and per day, for all the sensors at once.
+        """
+        pending, cls.__pending_rollups = cls.__pending_rollups, set()
+
+        hours = {}
+        for sensor, hour in pending:
+            hours.setdefault(hour, set()).add(sensor)
+
+        days = {}
+        for hour, sensors in hours.items():
+            days.setdefault(hour.replace(hour=0), set()).update(sensors)
+
+            parameters = {f"sensor{index}": sensor for index, sensor in enumerate(sorted(sensors))}
+            placeholders = ", ".join(f"${name}" for name in parameters)
+            parameters["start"] = f"{hour:%Y-%m-%d %H:00:00}"
+            parameters["end"] = f"{hour + timedelta(hours=1):%Y-%m-%d %H:00:00}"
+            db.execute(
+                f"""INSERT INTO "SensorHistoryHourly" ({cls.__ROLLUP_FIELDS})
+                    SELECT "sh"."sensor", $start, AVG("sh"."value"), MIN("sh"."value"), MAX("sh"."value"), AVG("sl"."limit_min"), AVG("sl"."limit_max"), AVG("sl"."alarm_min"), AVG("sl"."alarm_max"), MAX("sl"."exclude_avg"), COUNT(*)
+                    FROM "SensorHistory" AS "sh" {cls.LIMITS_JOIN}
+                    WHERE "sh"."sensor" IN ({placeholders})
+                      AND "sh"."timestamp" >= $start AND "sh"."timestamp" < $end
+                    GROUP BY "sh"."sensor"
+                    ON CONFLICT ("sensor", "timestamp") DO UPDATE SET {cls.__ROLLUP_UPDATE}""",
+                parameters,
             )
-            sensor_data.limit_max = (
-                self.limit_max if self.__VALUE_MODE == 3 else (sensor_data.limit_max + self.limit_max) / 2
+
+        for day, sensors in days.items():
+            parameters = {f"sensor{index}": sensor for index, sensor in enumerate(sorted(sensors))}
+            placeholders = ", ".join(f"${name}" for name in parameters)
+            parameters["start"] = f"{day:%Y-%m-%d 00:00:00}"
+            parameters["end"] = f"{day + timedelta(days=1):%Y-%m-%d 00:00:00}"
+            db.execute(
+                f"""INSERT INTO "SensorHistoryDaily" ({cls.__ROLLUP_FIELDS})
+                    SELECT "sensor", $start, SUM("value" * "samples") / SUM("samples"), MIN("value_min"), MAX("value_max"), SUM("limit_min" * "samples") / SUM("samples"), SUM("limit_max" * "samples") / SUM("samples"), SUM("alarm_min" * "samples") / SUM("samples"), SUM("alarm_max" * "samples") / SUM("samples"), MAX("exclude_avg"), SUM("samples")
+                    FROM "SensorHistoryHourly"
+                    WHERE "sensor" IN ({placeholders})
+                      AND "timestamp" >= $start AND "timestamp" < $end
+                    GROUP BY "sensor"
+                    ON CONFLICT ("sensor", "timestamp") DO UPDATE SET {cls.__ROLLUP_UPDATE}""",
+                parameters,
             )
-            sensor_data.alarm_min = (
-                self.alarm_min if self.__VALUE_MODE == 3 else (sensor_data.alarm_min + self.alarm_min) / 2
+
+    @classmethod
+    def __raw_history(cls, query, start, end, parameters, key=None):
+        # Older raw history is stored in the monthly partitions. A month is only in a partition or in the main database,
+        # so reading the partitions first and then the main database keeps the timestamps in order.
+        partitions = history_partitions.history(query, start, end, parameters, key)
+        rows = stream_query(
+            query('"main"."SensorHistory"'),
+            (*parameters, f"{start:%Y-%m-%d %H:%M:%S.%f}", f"{end:%Y-%m-%d %H:%M:%S.%f}"),
+        )
+        if key is None:
+            yield from partitions
+            yield from rows
+        else:
+            yield from heapq.merge(partitions, rows, key=key)
+
+    @classmethod
+    def export(cls, sensor, start, end=datetime.max):
+        return cls.__raw_history(
+            lambda table: f"""SELECT "sh"."timestamp", "sh"."value", "sl"."alarm_min", "sl"."alarm_max", "sl"."limit_min", "sl"."limit_max"
+                FROM {table} AS "sh" {cls.LIMITS_JOIN}
+                WHERE "sh"."sensor" = ? AND "sh"."timestamp" >= ? AND "sh"."timestamp" < ?
+                ORDER BY "sh"."timestamp" ASC""",
+            start,
+            end,
+            (sensor,),
+        )
+
+    @classmethod
+    def history(cls, start, end=datetime.max, sensors=None, sensor_type=None, resolution="minute"):
+        """
+        Yield the history of a single sensor, or the average of a list of sensors or a sensor type, oldest first. The
+        sensors that are excluded from the averages are skipped. The hour and day resolutions use the rollups.
+        """
+        if "minute" != resolution:
+            return cls.__rollup_history(start, end, sensors, sensor_type, resolution)
+
+        if sensor_type is not None:
+            return cls.__raw_history(
+                lambda table: f"""SELECT "sh"."timestamp", AVG("sh"."value"), AVG("sl"."alarm_min"), AVG("sl"."alarm_max")
+                    FROM {table} AS "sh" JOIN "Sensor" AS "sensor" ON "sensor"."id" = "sh"."sensor" {cls.LIMITS_JOIN}
+                    WHERE "sensor"."type" = ? AND "sl"."exclude_avg" = 0 AND "sh"."timestamp" >= ? AND "sh"."timestamp" < ?
+                    GROUP BY "sh"."timestamp"
+                    ORDER BY "sh"."timestamp" ASC""",
+                start,
+                end,
+                (sensor_type,),
             )
-            sensor_data.alarm_max = (
-                self.alarm_max if self.__VALUE_MODE == 3 else (sensor_data.alarm_max + self.alarm_max) / 2
+
+        if isinstance(sensors, list):
+            return cls.__raw_history(
+                lambda table: f"""SELECT "sh"."timestamp", AVG("sh"."value"), AVG("sl"."alarm_min"), AVG("sl"."alarm_max")
+                    FROM {table} AS "sh" {cls.LIMITS_JOIN}
+                    WHERE "sh"."sensor" IN ({", ".join(["?"] * len(sensors))}) AND "sl"."exclude_avg" = 0
+                      AND "sh"."timestamp" >= ? AND "sh"."timestamp" < ?
+                    GROUP BY "sh"."timestamp"
+                    ORDER BY "sh"."timestamp" ASC""",
+                start,
+                end,
+                tuple(sensors),
             )
 
-            sensor_data.exclude_avg = self.exclude_avg
-        else:
-            # New data
-            sensor_data = SensorHistory(
-                sensor=self,
-                timestamp=timestamp,
-                value=value,
-                limit_min=self.limit_min,
-                limit_max=self.limit_max,
-                alarm_min=self.alarm_min,
-                alarm_max=self.alarm_max,
-                exclude_avg=self.exclude_avg,
+        return cls.__raw_history(
+            lambda table: f"""SELECT "sh"."timestamp", "sh"."value", "sl"."alarm_min", "sl"."alarm_max"
+                FROM {table} AS "sh" {cls.LIMITS_JOIN}
+                WHERE "sh"."sensor" = ? AND "sh"."timestamp" >= ? AND "sh"."timestamp" < ?
+                ORDER BY "sh"."timestamp" ASC""",
+            start,
+            end,
+            (sensors,),
+        )
+
+    @classmethod
+    def __rollup_history(cls, start, end, sensors, sensor_type, resolution):
+        table = "SensorHistoryHourly" if "hour" == resolution else "SensorHistoryDaily"
+        # The rollup timestamps are stored without microseconds, unlike the raw history. So only add the microseconds
+        # to the period when they are set, else the rollup at the start of the period would sort before the start.
+        period = (start.isoformat(" "), end.isoformat(" "))
+        if sensor_type is not None:
+            return stream_query(
+                f"""SELECT "sh"."timestamp", AVG("sh"."value"), AVG("sh"."alarm_min"), AVG("sh"."alarm_max")
+                    FROM "{table}" AS "sh" JOIN "Sensor" AS "sensor" ON "sensor"."id" = "sh"."sensor"
+                    WHERE "sensor"."type" = ? AND "sh"."exclude_avg" = 0 AND "sh"."timestamp" >= ? AND "sh"."timestamp" < ?
+                    GROUP BY "sh"."timestamp"
+                    ORDER BY "sh"."timestamp" ASC""",
+                (sensor_type, *period),
             )
 
-        return sensor_data
+        if isinstance(sensors, list):
+            return stream_query(
+                f"""SELECT "sh"."timestamp", AVG("sh"."value"), AVG("sh"."alarm_min"), AVG("sh"."alarm_max")
+                    FROM "{table}" AS "sh"
+                    WHERE "sh"."sensor" IN ({", ".join(["?"] * len(sensors))}) AND "sh"."exclude_avg" = 0
+                      AND "sh"."timestamp" >= ? AND "sh"."timestamp" < ?
+                    GROUP BY "sh"."timestamp"
+                    ORDER BY "sh"."timestamp" ASC""",
+                (*sensors, *period),
+            )
 
-    def __repr__(self):
-        return f"{self.hardware} {self.type} named '{self.name}' at address '{self.address}'"
+        return stream_query(
+            f"""SELECT "sh"."timestamp", "sh"."value", "sh"."alarm_min", "sh"."alarm_max"
+                FROM "{table}" AS "sh"
+                WHERE "sh"."sensor" = ? AND "sh"."timestamp" >= ? AND "sh"."timestamp" < ?
+                ORDER BY "sh"."timestamp" ASC""",
+            (sensors, *period),
+        )
 
+    @classmethod
+    def bulk(cls, sensors, start, end=datetime.max, resolution="minute"):
+        # The history of multiple sensors in one query, ordered by sensor. The hour and day resolutions use the rollups
+        placeholders = ", ".join(["?"] * len(sensors))
+        if "minute" == resolution:
+            # Every partition is ordered by sensor on its own, so they are merged back into a single ordered stream
+            return cls.__raw_history(
+                lambda table: f"""SELECT "sh"."sensor", "sh"."timestamp", "sh"."value", "sl"."alarm_min", "sl"."alarm_max"
+                    FROM {table} AS "sh" {cls.LIMITS_JOIN}
+                    WHERE "sh"."sensor" IN ({placeholders}) AND "sh"."timestamp" >= ? AND "sh"."timestamp" < ?
+                    ORDER BY "sh"."sensor" ASC, "sh"."timestamp" ASC""",
+                start,
+                end,
+                tuple(sensors),
+                key=lambda row: (row[0], row[1]),
+            )
 
-class SensorHistory(db.Entity):
+        # The rollup timestamps are stored without microseconds, unlike the raw history. So only add the microseconds
+        # to the period when they are set, else the rollup at the start of the period would sort before the start.
+        return stream_query(
+            f"""SELECT "sensor", "timestamp", "value", "alarm_min", "alarm_max"
+                FROM "{'SensorHistoryHourly' if 'hour' == resolution else 'SensorHistoryDaily'}"
+                WHERE "sensor" IN ({placeholders}) AND "timestamp" >= ? AND "timestamp" < ?
+                ORDER BY "sensor" ASC, "timestamp" ASC""",
+            (*sensors, start.isoformat(" "), end.isoformat(" ")),
+        )
+
+
+history_writer.on_flush(SensorHistory.update_rollups)
+
+
+class SensorHistoryLimits(db.Entity):
+    sensor = orm.Required("Sensor")
+
+    # The moment from which these limits and alarm values are used
+    timestamp = orm.Required(datetime)
+    limit_min = orm.Required(float)
+    limit_max = orm.Required(float)
+    alarm_min = orm.Required(float)
+    alarm_max = orm.Required(float)
+
+    exclude_avg = orm.Required(bool, default=False)
+
+    orm.PrimaryKey(sensor, timestamp)
+
+
+class SensorHistoryHourly(db.Entity):
     sensor = orm.Required("Sensor")
 
     timestamp = orm.Required(datetime)
     value = orm.Required(float)
+    value_min = orm.Required(float)
+    value_max = orm.Required(float)
     limit_min = orm.Required(float)
     limit_max = orm.Required(float)
     alarm_min = orm.Required(float)
     alarm_max = orm.Required(float)
 
     exclude_avg = orm.Required(bool, default=False)
+    samples = orm.Required(int)
 
     orm.PrimaryKey(sensor, timestamp)
 
-    @property
-    def alarm(self):
-        if self.value is None:
-            return False
 
-        return not self.alarm_min <= self.value <= self.alarm_max
+class SensorHistoryDaily(db.Entity):
+    sensor = orm.Required("Sensor")
+
+    timestamp = orm.Required(datetime)
+    value = orm.Required(float)
+    value_min = orm.Required(float)
+    value_max = orm.Required(float)
+    limit_min = orm.Required(float)
+    limit_max = orm.Required(float)
+    alarm_min = orm.Required(float)
+    alarm_max = orm.Required(float)
+
+    exclude_avg = orm.Required(bool, default=False)
+    samples = orm.Required(int)
+
+    orm.PrimaryKey(sensor, timestamp)
 
 
 class Setting(db.Entity):
@@ -7,6 +7,7 @@ from terrariumArea import terrariumArea
 from terrariumUtils import terrariumUtils
 
 import copy
+import time
 
 
 class terrariumEnclosure(object):
@@ -86,7 +87,7 @@ class terrariumEnclosure(object):
 
         return True
 
-    def update(self, read_only=False):
+    def update(self, read_only=False, profile=None):
         area_states = {}
 
         # Construct a list in the order of:
@@ -106,7 +107,10 @@ class terrariumEnclosure(object):
                 # This area is already processed...
                 continue
 
+            start = time.time()
             area_states[area_id] = self.areas[area_id].update(read_only)
+            if profile is not None:
+                profile.area(self, self.areas[area_id], time.time() - start)
 
         return area_states
 
@@ -9,7 +9,6 @@ import time
 import datetime
 import os
 import psutil
-import subprocess
 import re
 import pyfiglet
 import copy
@@ -24,8 +23,22 @@ from packaging.version import Version
 from pyfancy.pyfancy import pyfancy
 
 from pony import orm
-from terrariumDatabase import init as init_db, db, Setting, Sensor, Relay, Enclosure
+from terrariumDatabase import (
+    init as init_db,
+    db,
+    latest_values,
+    history_writer,
+    history_cleanup,
+    history_partitions,
+    db_executor,
+    Setting,
+    Sensor,
+    Relay,
+    Enclosure,
+)
 from terrariumWebserver import terrariumWebserver
+from terrariumAPI import api_cache
+from terrariumMetrics import metrics, profiler
 from terrariumCalendar import terrariumCalendar
 from terrariumUtils import terrariumUtils, terrariumAsync
 from terrariumEnclosure import terrariumEnclosure
@@ -49,6 +62,8 @@ def N_(message):
 class terrariumEngine(object):
     __ENGINE_LOOP_TIMEOUT = 30.0  # in seconds
     __VERSION_UPDATE_CHECK_TIMEOUT = 1  # in days
+    __HISTORY_CLEANUP_MAX_DURATION = 5.0  # in seconds
+    __LOG_STREAM_INTERVAL = 1.0  # in seconds
 
     def __init__(self, version):
         self.starttime = time.time()
@@ -96,14 +111,18 @@ class terrariumEngine(object):
         # Dirty hack... :(
         self.device = Path("/proc/device-tree/model").read_text().rstrip('\x00')
         init_db(self.version)
+        # Start the write-behind history writer
+        history_writer.start()
+        # Start the threads for the heavy database queries
+        db_executor.start()
 
         # Send message that startup is ready..... else the startup will wait until done.... can take more then 1 minute
         self.__engine["systemd"].notify("READY=1")
         self.running = True
 
         # Make the first round of logging visible to the console, as this is the startup
-        old_log_level = terrariumLogging.logging.getLogger().handlers[0].level
-        terrariumLogging.logging.getLogger().handlers[0].setLevel(terrariumLogging.logging.INFO)
+        old_log_level = terrariumLogging.root_handlers[0].level
+        terrariumLogging.root_handlers[0].setLevel(terrariumLogging.logging.INFO)
         startup_message = f"Starting up TerrariumPI {self.version} on a {self.device} ..."
         logger.info(startup_message)
 
@@ -167,7 +186,7 @@ class terrariumEngine(object):
         self.notification.broadcast(startup_message, startup_message, self.settings["profile_image"])
 
         # Return console logging back to 'normal'
-        terrariumLogging.logging.getLogger().handlers[0].setLevel(old_log_level)
+        terrariumLogging.root_handlers[0].setLevel(old_log_level)
         self.__engine["logtail"] = threading.Thread(target=self.__log_tailing)
         self.__engine["thread"] = threading.Thread(target=self.__engine_loop)
 
@@ -328,8 +347,22 @@ class terrariumEngine(object):
             self.units["windspeed"] = "Bf"
             # https://stackoverflow.com/questions/60001991/how-to-convert-windspeed-between-beaufort-scale-and-m-s-and-vice-versa-in-javasc
 
+        # History retention in days. An empty or invalid value will keep the history forever (0)
+        retention = {}
+        for resolution in ["minute", "hourly", "daily"]:
+            value = settings[f"history_retention_{resolution}"]
+            retention[resolution] = int(float(value)) if terrariumUtils.is_float(value) else 0
+
+        history_cleanup.set_retention(**retention)
+
+        # Amount of threads for the heavy database queries. An empty or invalid value will use the default of 2 threads
+        value = settings["database_threads"]
+        db_executor.set_concurrency(max(1, int(float(value)) if terrariumUtils.is_float(value) else 2))
+
         # Replace active settings with the new settings
         self.settings = settings
+        # Settings like units and excluded ids are used in all API responses
+        api_cache.clear()
         logger.info(f"Loaded {len(settings)} settings in {time.time()-start:.2f} seconds.")
 
         # Loading active language
@@ -499,12 +532,21 @@ class terrariumEngine(object):
             if item_id in self.relays:
                 self.relays[item_id].stop()
                 del self.relays[item_id]
+            latest_values.clear("relay", item_id)
+            self.webserver.websocket_remove("relay", item_id)
             delete_ok = True
 
         elif issubclass(item, terrariumSensor):
             if item_id in self.sensors:
+                sensor_type = self.sensors[item_id].type
                 self.sensors[item_id].stop()
                 del self.sensors[item_id]
+                # The average of a sensor type is send with the type as id
+                if not any(sensor.type == sensor_type for sensor in self.sensors.values()):
+                    self.webserver.websocket_remove("sensor", sensor_type)
+            latest_values.clear("sensor", item_id)
+            self.webserver.websocket_remove("sensor", item_id)
+            history_partitions.delete_sensor(item_id)
             delete_ok = True
 
         #elif issubclass(item, terrariumWebcam):
@@ -685,7 +727,7 @@ class terrariumEngine(object):
 
                 sensor_data["unit"] = self.units[sensor.type]
                 sensor_data["type"] = sensor.type
-                self.webserver.websocket_message(
+                self.webserver.websocket_update(
                     "sensor",
                     {
                         field: sensor_data[field]
@@ -726,17 +768,18 @@ class terrariumEngine(object):
 
         for sensor_type, avg_data in self.sensor_averages.items():
             avg_data["id"] = sensor_type
-            self.webserver.websocket_message("sensor", avg_data)
+            self.webserver.websocket_update("sensor", avg_data)
 
         return True
 
     @property
     def sensor_averages(self):
         start = time.time()
-        data = {}
 
-        with orm.db_session():
-            for sensor in Sensor.select(lambda s: s.exclude_avg == False and not s.id in self.settings["exclude_ids"]):
+        @orm.db_session()
+        def totals(exclude_ids):
+            data = {}
+            for sensor in Sensor.select(lambda s: s.exclude_avg == False and not s.id in exclude_ids):
                 if sensor.type not in data:
                     data[sensor.type] = {
                         "value": 0.0,
@@ -760,6 +803,10 @@ class terrariumEngine(object):
 
                 data[sensor.type]["count"] += 1.0
 
+            return data
+
+        data = db_executor.run(totals, self.settings["exclude_ids"])
+
         averages = {}
         for sensor_type, sensor_data in data.items():
             count = sensor_data["count"]
@@ -909,7 +956,7 @@ class terrariumEngine(object):
                 relay_data = relay.to_dict()
 
             db_time = (time.time() - start) - measurement_time
-            self.webserver.websocket_message("relay", {"id": relay.id, "value": new_value})
+            self.webserver.websocket_update("relay", {"id": relay.id, "value": new_value})
 
             logger.info(
                 f"Updated relay {relay} with new value {new_value:.2f} in {measurement_time+db_time:.2f} seconds."
@@ -927,8 +974,6 @@ class terrariumEngine(object):
             # A small sleep between sensor measurement to get a bit more responsiveness of the system
             sleep(0.1)
 
-        self.webserver.websocket_message("power_usage_water_flow", self.get_power_usage_water_flow)
-
     # -= NEW =-
     def toggle_relay(self, relay, action="toggle", duration=0):
         ok = False
@@ -958,6 +1003,11 @@ class terrariumEngine(object):
             relay.update(state)
             relay_data = relay.to_dict()
 
+        # Write the new state directly, so the power and water totals are up to date
+        history_writer.flush()
+        # The enclosures show the relay states as well
+        api_cache.invalidate("relays", "enclosures")
+
         # Update totals through websocket
         self.webserver.websocket_message("power_usage_water_flow", self.get_power_usage_water_flow)
 
@@ -1075,6 +1125,7 @@ class terrariumEngine(object):
 
         # Update the button state on the button page
         self.webserver.websocket_message("button", button_data)
+        api_cache.invalidate("buttons")
 
         # Notification message
         self.notification.message("button_action", button_data)
@@ -1217,24 +1268,28 @@ class terrariumEngine(object):
                 logger.info(f"Loaded {enclosure} in {time.time()-start:.2f} seconds.")
 
     # -= NEW =-
-    def _update_enclosures(self, read_only=False):
+    def _update_enclosures(self, read_only=False, profile=None):
         with orm.db_session():
             for enclosure in Enclosure.select():
                 if str(enclosure.id) not in self.enclosures or str(enclosure.id) in self.settings["exclude_ids"]:
                     continue
 
                 start = time.time()
-                area_states = self.enclosures[str(enclosure.id)].update(read_only)
+                area_states = self.enclosures[str(enclosure.id)].update(read_only, profile)
                 for area in enclosure.areas:
                     area_state = area_states.get(str(area.id), None)
                     if area_state:
                         area.state = area_state
 
                 measurement_time = time.time() - start
+                if profile is not None:
+                    profile.enclosure(self.enclosures[str(enclosure.id)], measurement_time)
 
                 logger.info(f"Updated {enclosure} in {measurement_time:.2f} seconds.")
                 logger.debug(f"Updated {enclosure}. M: {measurement_time:.2f} sec.")
 
+        api_cache.invalidate("enclosures")
+
     # -= NEW =-
     def __engine_loop(self):
         logger.info(f"Starting engine updater with {terrariumEngine.__ENGINE_LOOP_TIMEOUT:.2f} seconds interval.")
@@ -1248,45 +1303,69 @@ class terrariumEngine(object):
             logger.info(
                 f"Starting a new update round with {len(self.sensors)} sensors and {len(self.relays)} relays."
             )
-            start = time.time()
+            profile = profiler.start(terrariumEngine.__ENGINE_LOOP_TIMEOUT)
+            start = profile.start
 
             # Weather data
             if self.weather is not None:
-                self.weather.update()
+                with profile.phase("weather"):
+                    self.weather.update()
 
             # System stats (needs weather update)
-            self.webserver.websocket_message("systemstats", self.system_stats())
+            with profile.phase("system_stats"):
+                self.webserver.websocket_message("systemstats", self.system_stats())
 
             # Run updates in parallel and wait till all done
             with futures.ThreadPoolExecutor() as pool:
-                pool.submit(self._update_sensors)
-                pool.submit(self._update_relays)
+                pool.submit(profile.phase("sensors")(self._update_sensors))
+                pool.submit(profile.phase("relays")(self._update_relays))
                 #pool.submit(self._update_buttons)
                 #pool.submit(self._update_webcams)
-                pool.submit(self.__update_checker)
+                pool.submit(profile.phase("update_checker")(self.__update_checker))
+
+            # Write all the history data of this round in one transaction
+            with profile.phase("history"):
+                history_writer.flush()
+
+            api_cache.invalidate("sensors", "relays", "buttons")
+            # Send all the sensor and relay changes of this round in one message
+            self.webserver.websocket_flush()
+            self.webserver.websocket_message("power_usage_water_flow", self.get_power_usage_water_flow)
 
             # Run encounter/environment updates
-            self._update_enclosures()
+            with profile.phase("enclosures"):
+                self._update_enclosures(profile=profile)
 
-            self.motd()
+            with profile.phase("motd"):
+                self.motd()
 
             # Cleanup hanging bluetooth helper scripts....
-            current_process = psutil.Process()
-            for process in current_process.children(recursive=True):
-                if "bluepy-helper" in " ".join(process.cmdline()):
-                    try:
-                        logger.warning("Killing hanging bluetooth helper process")
-                        process.kill()
-                    except Exception as ex:
-                        logger.error(f"Error killing hanging bluetooth helper process: {ex}")
-
-            duration = time.time() - start
+            with profile.phase("bluetooth_cleanup"):
+                current_process = psutil.Process()
+                for process in current_process.children(recursive=True):
+                    if "bluepy-helper" in " ".join(process.cmdline()):
+                        try:
+                            logger.warning("Killing hanging bluetooth helper process")
+                            process.kill()
+                        except Exception as ex:
+                            logger.error(f"Error killing hanging bluetooth helper process: {ex}")
+
+            profile.finish()
+            duration = profile.duration
             time_left = terrariumEngine.__ENGINE_LOOP_TIMEOUT - duration
 
+            # Keep the timing breakdown of this round
+            profile_data = profiler.add(profile)
+            self.webserver.websocket_message("engine_profile", profile_data)
+
             if time_left > 0.0:
                 logger.info(
                     f"Engine update done in {duration:.2f} seconds. Waiting for {time_left:.2f} seconds for the next round."
                 )
+                # Use some of the idle time to clean up old history data
+                self.__history_cleanup(time_left)
+                time_left = terrariumEngine.__ENGINE_LOOP_TIMEOUT - (time.time() - start)
+
                 # Here we wait....
                 self.__engine["exit"].wait(max(0, time_left - prev_delay))
                 # Reset the delay from last round to zero.
@@ -1295,15 +1374,20 @@ class terrariumEngine(object):
                 self.__engine["too_late"] = 0
 
             else:
+                metrics.inc("terrariumpi_engine_loop_overruns_total")
                 self.__engine["too_late"] += 1
                 prev_delay = abs(time_left)
-                message = f"Engine update took {duration:.2f} seconds. That is {prev_delay:.2f} seconds short."
+                slowest = ", ".join(
+                    f'{component["name"]} ({component["duration"]:.2f} seconds)' for component in profile_data["slowest"]
+                )
+                message = f"Engine update took {duration:.2f} seconds. That is {prev_delay:.2f} seconds short. Slowest parts: {slowest}."
                 message_data = {
                     "message": message,
                     "time_short": prev_delay,
                     "update_duration": duration,
                     "loop_timeout": terrariumEngine.__ENGINE_LOOP_TIMEOUT,
                     "times_late": self.__engine["too_late"],
+                    "slowest": slowest,
                 }
                 self.notification.message("system_update_warning", message_data)
                 logger.warning(message)
@@ -1316,6 +1400,13 @@ class terrariumEngine(object):
 
         logger.info("Stopped main engine thread")
 
+    def __history_cleanup(self, time_left):
+        # Use at most half of the idle time
+        deadline = time.time() + min(time_left / 2.0, terrariumEngine.__HISTORY_CLEANUP_MAX_DURATION)
+        progress = history_cleanup.run(deadline)
+        if progress is not None:
+            self.webserver.websocket_message("history_cleanup", progress)
+
     def motd(self):
         # Enable translations
         _ = terrariumUtils.get_translator(self.active_language)
@@ -1671,27 +1762,28 @@ class terrariumEngine(object):
     # -= NEW =-
     def __log_tailing(self):
         logger.info("Starting log tailing.")
-        with subprocess.Popen(
-            ["tail", "-F", terrariumLogging.logging.getLogger().handlers[1].baseFilename],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        ) as self.__logtail_process:
-            for line in self.__logtail_process.stdout:
-                self.webserver.websocket_message("logline", line.strip())
+        sequence = terrariumLogging.log_buffer.sequence
+        while not self.__engine["exit"].is_set():
+            lines = terrariumLogging.log_buffer.wait(sequence, terrariumEngine.__LOG_STREAM_INTERVAL)
+            if len(lines) > 0:
+                sequence = lines[-1][0]
+                # Send all the new lines in one message. The web interface adds them on top, so the newest line goes first
+                self.webserver.websocket_message("logline", "\n".join(line for _, line in reversed(lines)))
+
+            # Rate limit the messages, the lines of the next interval will be batched
+            self.__engine["exit"].wait(terrariumEngine.__LOG_STREAM_INTERVAL)
 
         logger.info("Stopped log tailing.")
 
     # -= NEW =-
     def stop(self):
-        terrariumLogging.logging.getLogger().handlers[0].setLevel(terrariumLogging.logging.INFO)
+        terrariumLogging.root_handlers[0].setLevel(terrariumLogging.logging.INFO)
         logger.info(f"Stopping TerrariumPI {self.version} ...")
 
         self.running = False
         self.__engine["exit"].set()
 
         # Wait till the engine is done, when it was updating the sensors
-        self.__logtail_process.terminate()
         self.__engine["thread"].join()
         self.__engine["logtail"].join()
 
@@ -1718,6 +1810,12 @@ class terrariumEngine(object):
         if self.meross_cloud is not None:
             self.meross_cloud.stop()
 
+        history_writer.stop()
+        logger.info(f"Stopped history writer: {history_writer.stats}")
+
+        db_executor.stop()
+        logger.info(f"Stopped database executor: {db_executor.stats}")
+
         shutdown_message = f"Stopped TerrariumPI {self.version} after running for {terrariumUtils.format_uptime(time.time()-self.starttime)}. Bye bye."
         self.notification.broadcast(shutdown_message, shutdown_message, self.settings["profile_image"])
         self.notification.stop()
@@ -1892,27 +1990,16 @@ class terrariumEngine(object):
     # -= NEW =-
     @property
     def total_power_and_water_usage(self):
-        # We are using total() vs sum() as total() will always return a number. https://sqlite.org/lang_aggfunc.html#sumunc
-        with orm.db_session():
-            data = db.select(
+        # The totals are kept up to date per relay when new relay history is stored. We are using total() vs sum() as total() will always return a number. https://sqlite.org/lang_aggfunc.html#sumunc
+        @orm.db_session()
+        def totals():
+            return db.select(
                 """SELECT
-             DISTINCT relay,
              TOTAL(total_wattage) AS wattage,
              TOTAL(total_flow)    AS flow,
-             IFNULL((JulianDay(MAX(timestamp2)) - JulianDay(MIN(timestamp))) * 24 * 60 * 60,0) AS timestamp
-           FROM (
-             SELECT
-               RH1.relay     as relay,
-               RH1.timestamp as timestamp,
-               RH2.timestamp as timestamp2,
-                 (JulianDay(RH2.timestamp)-JulianDay(RH1.timestamp))* 24 * 60 * 60                        AS duration_in_seconds,
-                ((JulianDay(RH2.timestamp)-JulianDay(RH1.timestamp))* 24 * 60 * 60)         * RH1.wattage AS total_wattage,
-               (((JulianDay(RH2.timestamp)-JulianDay(RH1.timestamp))* 24 * 60 * 60) / 60.0) * RH1.flow    AS total_flow
-             FROM RelayHistory AS RH1
-               LEFT JOIN RelayHistory AS RH2
-                 ON RH2.relay = RH1.relay
-                 AND RH2.timestamp = (SELECT MIN(timestamp) FROM RelayHistory WHERE timestamp > RH1.timestamp AND relay = RH1.relay)
-                 WHERE RH1.value > 0)"""
+             IFNULL((JulianDay(MAX(period_end)) - JulianDay(MIN(period_start))) * 24 * 60 * 60,0) AS timestamp
+           FROM RelayUsage"""
             )
 
-            return {"total_watt": data[0][1], "total_flow": data[0][2], "duration": data[0][3]}
+        data = db_executor.run(totals)
+        return {"total_watt": data[0][0], "total_flow": data[0][1], "duration": data[0][2]}
@@ -11,6 +11,11 @@ import time
 import glob
 import shutil
 import threading
+import atexit
+import copy
+import queue
+
+from collections import deque
 
 from terrariumNotification import terrariumNotification
 from terrariumUtils import terrariumUtils
@@ -86,7 +91,109 @@ class NotificationLogger(logging.StreamHandler):
             self.notification.message(f"system_{data.levelname.lower()}", {"message": data.getMessage()})
 
 
+class LogBufferHandler(logging.Handler):
+    """
+    Keeps the last log lines in a bounded ring buffer in memory, so they can be streamed to the web interface without
+    reading the log file back. Every line gets a sequence number, so readers can continue where they stopped.
+    """
+
+    def __init__(self, capacity=1000):
+        super(LogBufferHandler, self).__init__()
+        self.__lines = deque(maxlen=int(capacity))
+        self.__sequence = 0
+        self.__new_lines = threading.Condition()
+
+    @property
+    def sequence(self):
+        return self.__sequence
+
+    def emit(self, data):
+        try:
+            line = terrariumUtils.clean_log_line(self.format(data))
+        except Exception:
+            self.handleError(data)
+            return
+
+        with self.__new_lines:
+            self.__sequence += 1
+            self.__lines.append((self.__sequence, line))
+            self.__new_lines.notify_all()
+
+    def lines(self, since=0):
+        """
+        The buffered lines after sequence number `since` as (sequence, line) tuples, oldest first
+        """
+        with self.__new_lines:
+            return [(sequence, line) for sequence, line in self.__lines if sequence > since]
+
+    def wait(self, since, timeout=None):
+        """
+        Wait till there are new lines after sequence number `since`, and return them. Returns an empty list on a timeout
+        """
+        with self.__new_lines:
+            self.__new_lines.wait_for(lambda: self.__sequence > since, timeout)
+
+        return self.lines(since)
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler for a listener in the same process. The stock handler formats the record and adds the traceback to
+    the message, so the notifications would send the full tracebacks. This only merges the arguments in the message,
+    and every handler formats the record and the traceback on its own, like it does without the queue.
+    """
+
+    def prepare(self, data):
+        data = copy.copy(data)
+        data.msg = data.getMessage()
+        data.args = None
+        return data
+
+
 if os.path.isfile("log/logging.custom.cfg"):
     logging.config.fileConfig("log/logging.custom.cfg")
 else:
     logging.config.fileConfig("logging.cfg")
+
+# The web interface streams the log lines from the memory buffer. Add it when a custom logging config does not have it
+log_buffer = next(
+    (handler for handler in logging.getLogger().handlers if isinstance(handler, LogBufferHandler)),
+    None,
+)
+if log_buffer is None:
+    log_buffer = LogBufferHandler()
+    log_buffer.setLevel(logging.INFO)
+    log_buffer.setFormatter(logging.Formatter("%(asctime)s - %(levelname)-7s - %(name)-21s - %(message)s"))
+    logging.getLogger().addHandler(log_buffer)
+
+
+def queue_logging(logger):
+    """
+    Move the handlers of the logger behind a queue. The logger only puts the records on the queue, and a background
+    listener will clean, write and send them. So logging never blocks on disk or network, like the notifications.
+    """
+    handlers = tuple(logger.handlers)
+    if len(handlers) == 0:
+        return handlers
+
+    listener = logging.handlers.QueueListener(queue.SimpleQueue(), *handlers, respect_handler_level=True)
+    queue_handler = LocalQueueHandler(listener.queue)
+    # Do not queue records that none of the handlers will use, like debug messages. The levels can change at runtime
+    queue_handler.addFilter(lambda data: any(data.levelno >= handler.level for handler in handlers))
+
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    logger.addHandler(queue_handler)
+    listener.start()
+    # Write the last queued records on exit
+    atexit.register(listener.stop)
+
+    return handlers
+
+
+# The original handlers of the root logger, in the order of the logging config
+root_handlers = queue_logging(logging.getLogger())
+for logger in list(logging.root.manager.loggerDict.values()):
+    if isinstance(logger, logging.Logger):
+        queue_logging(logger)
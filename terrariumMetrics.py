@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+import terrariumLogging
+
+logger = terrariumLogging.logging.getLogger(__name__)
+
+import copy
+import threading
+import time
+
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+from terrariumUtils import terrariumSingleton
+
+
+class terrariumMetrics(terrariumSingleton):
+    """
+    Counters and histograms of the hardware, engine, database and notification timings. They are exported in the
+    Prometheus text format, so they can be scraped without any extra dependencies.
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    # Histogram buckets in seconds. From fast GPIO actions up to the engine loop and hardware timeouts
+    __BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0, 60.0)
+
+    __METRICS = {
+        "terrariumpi_hardware_seconds": (
+            "histogram",
+            "Duration of a single hardware read or switch action of a sensor or relay",
+        ),
+        "terrariumpi_hardware_errors_total": (
+            "counter",
+            "Failed hardware reads or switch actions of a sensor or relay. Each failure is retried up to 3 times",
+        ),
+        "terrariumpi_hardware_timeouts_total": (
+            "counter",
+            "Hardware reads or switch actions of a sensor or relay that timed out",
+        ),
+        "terrariumpi_engine_phase_seconds": ("histogram", "Duration of the phases of the engine update loop"),
+        "terrariumpi_engine_loop_seconds": ("histogram", "Duration of a full engine update loop"),
+        "terrariumpi_engine_loop_overruns_total": ("counter", "Engine update loops that took longer than the timeout"),
+        "terrariumpi_db_transaction_seconds": ("histogram", "Duration of the database transactions and queries"),
+        "terrariumpi_notification_dispatch_seconds": (
+            "histogram",
+            "Duration of handing over a notification message to a service",
+        ),
+        "terrariumpi_websocket_clients": ("gauge", "Connected websocket clients"),
+        "terrariumpi_websocket_queue_depth": ("gauge", "Messages waiting in all the websocket client queues"),
+        "terrariumpi_websocket_queue_depth_max": ("gauge", "Messages waiting in the fullest websocket client queue"),
+        "terrariumpi_websocket_dropped_messages_total": (
+            "counter",
+            "Websocket messages that are dropped from a full client queue, the oldest message with the same topic first",
+        ),
+        "terrariumpi_websocket_disconnects_total": ("counter", "Stalled websocket clients that are disconnected"),
+    }
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__values = {name: {} for name in self.__METRICS}
+        self.__gauges = {}
+
+    def __labels(self, labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        if self.__METRICS[name][0] != "counter":
+            raise TypeError(f"Metric {name} is not a counter")
+
+        labels = self.__labels(labels)
+        with self.__lock:
+            self.__values[name][labels] = self.__values[name].get(labels, 0) + value
+
+    def observe(self, name, value, **labels):
+        if self.__METRICS[name][0] != "histogram":
+            raise TypeError(f"Metric {name} is not a histogram")
+
+        labels = self.__labels(labels)
+        with self.__lock:
+            if labels not in self.__values[name]:
+                # Per bucket counts, with an extra bucket for +Inf, followed by the sum and the count
+                self.__values[name][labels] = [[0] * (len(self.__BUCKETS) + 1), 0.0, 0]
+
+            histogram = self.__values[name][labels]
+            histogram[0][bisect_left(self.__BUCKETS, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the duration of the block in the histogram. This can also be used as a function decorator.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def gauge(self, name, callback):
+        """
+        Register a callback for a gauge. It is called during the export and should return the current value.
+        """
+        if self.__METRICS[name][0] != "gauge":
+            raise TypeError(f"Metric {name} is not a gauge")
+
+        self.__gauges[name] = callback
+
+    def __format_labels(self, labels, extra=()):
+        labels = [*labels, *extra]
+        if len(labels) == 0:
+            return ""
+
+        labels = ",".join(
+            f'{key}="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+            for key, value in labels
+        )
+        return "{" + labels + "}"
+
+    def export(self):
+        lines = []
+        with self.__lock:
+            values = copy.deepcopy(self.__values)
+
+        for name, (metric_type, description) in self.__METRICS.items():
+            if metric_type == "gauge":
+                if name not in self.__gauges:
+                    continue
+
+                try:
+                    values[name] = {(): self.__gauges[name]()}
+                except Exception as ex:
+                    logger.debug(f"Could not get the value of gauge {name}: {ex}")
+                    continue
+
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+            for labels, value in values[name].items():
+                if metric_type != "histogram":
+                    lines.append(f"{name}{self.__format_labels(labels)} {value}")
+                    continue
+
+                counts, total, count = value
+                cumulative = 0
+                for bucket, bucket_count in zip([*self.__BUCKETS, "+Inf"], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{self.__format_labels(labels, [('le', str(bucket))])} {cumulative}")
+
+                lines.append(f"{name}_sum{self.__format_labels(labels)} {total}")
+                lines.append(f"{name}_count{self.__format_labels(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = terrariumMetrics()
+
+
+class terrariumEngineProfile(object):
+    """
+    Timing breakdown of a single engine update round.
+    """
+
+    def __init__(self, timeout):
+        self.__lock = threading.Lock()
+        self.start = time.time()
+        self.timeout = timeout
+        self.duration = None
+        self.phases = {}
+        self.enclosures = {}
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the update round. This can also be used as a function decorator for the parallel updates.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            metrics.observe("terrariumpi_engine_phase_seconds", duration, phase=name)
+            with self.__lock:
+                self.phases[name] = duration
+
+    def __enclosure(self, enclosure):
+        if str(enclosure.id) not in self.enclosures:
+            self.enclosures[str(enclosure.id)] = {"name": enclosure.name, "duration": 0.0, "areas": {}}
+
+        return self.enclosures[str(enclosure.id)]
+
+    def enclosure(self, enclosure, duration):
+        with self.__lock:
+            self.__enclosure(enclosure)["duration"] = duration
+
+    def area(self, enclosure, area, duration):
+        with self.__lock:
+            self.__enclosure(enclosure)["areas"][str(area.id)] = {"name": area.name, "duration": duration}
+
+    def finish(self):
+        self.duration = time.time() - self.start
+        metrics.observe("terrariumpi_engine_loop_seconds", self.duration)
+
+    @property
+    def overrun(self):
+        return self.duration is not None and self.duration > self.timeout
+
+    def slowest(self, amount=3):
+        """
+        The slowest parts of the update round. The enclosures are split up in their areas.
+        """
+        with self.__lock:
+            components = [{"name": name, "duration": duration} for name, duration in self.phases.items()]
+            if len(self.enclosures) > 0:
+                components = [component for component in components if component["name"] != "enclosures"]
+
+            for enclosure in self.enclosures.values():
+                components += [
+                    {"name": f'{enclosure["name"]} / {area["name"]}', "duration": area["duration"]}
+                    for area in enclosure["areas"].values()
+                ]
+
+        return sorted(components, key=lambda component: component["duration"], reverse=True)[:amount]
+
+    def to_dict(self):
+        with self.__lock:
+            data = {
+                "start": self.start,
+                "duration": self.duration,
+                "timeout": self.timeout,
+                "overrun": self.overrun,
+                "phases": copy.copy(self.phases),
+                "enclosures": copy.deepcopy(self.enclosures),
+            }
+
+        data["slowest"] = self.slowest()
+        return data
+
+
+class terrariumEngineProfiler(terrariumSingleton):
+    """
+    Keeps the timing breakdown of the last engine update rounds in a ring buffer.
+    """
+
+    __ROUNDS = 60
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__rounds = deque(maxlen=terrariumEngineProfiler.__ROUNDS)
+
+    def start(self, timeout):
+        return terrariumEngineProfile(timeout)
+
+    def add(self, profile):
+        profile = profile.to_dict()
+        with self.__lock:
+            self.__rounds.append(profile)
+
+        return profile
+
+    @property
+    def rounds(self):
+        with self.__lock:
+            return list(self.__rounds)
+
+
+profiler = terrariumEngineProfiler()
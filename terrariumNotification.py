@@ -30,6 +30,7 @@ from pathlib import Path
 
 from terrariumDatabase import NotificationMessage, NotificationService
 from terrariumUtils import terrariumUtils, terrariumSingleton, classproperty
+from terrariumMetrics import metrics
 
 # Display support
 from hardware.display import terrariumDisplay, terrariumDisplayLoadingException
@@ -98,6 +99,7 @@ class terrariumNotification(terrariumSingleton):
                 "update_duration": N_("The update duration in seconds"),
                 "loop_timeout": N_("The max update duration"),
                 "times_late": N_("Amount of times to late with updates"),
+                "slowest": N_("The slowest parts of the update"),
                 **__DEFAULT_PLACEHOLDERS,
             },
         },
@@ -382,7 +384,8 @@ class terrariumNotification(terrariumSingleton):
 
                     try:
                         message_data = data.copy()
-                        self.services[service.id].send_message(message_type, title, text, message_data)
+                        with metrics.timer("terrariumpi_notification_dispatch_seconds", service=service.type):
+                            self.services[service.id].send_message(message_type, title, text, message_data)
                     except Exception as ex:
                         logger.exception(f"Error sending notification message '{title}': {ex}")
 
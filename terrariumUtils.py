@@ -16,6 +16,7 @@ import math
 import asyncio
 import base64
 import collections
+import numpy
 
 from cryptography.fernet import Fernet
 
@@ -456,6 +457,34 @@ class terrariumUtils:
         power, n = min(int(log(max(n * b**power, 1), b)), len(pre) - 1), n * b**power
         return "%%.%if %%s%%s" % abs(power % (-power - 1)) % (n / b ** float(power), pre[power], u)
 
+    @staticmethod
+    def downsample(values, max_points):
+        """
+        Min/max per bucket downsampling for graphs. Returns the sorted indexes of the points to keep.
+
+        The first and last point are always kept, and the other points are divided in equal buckets. Of every bucket
+        the lowest and the highest value are kept, so short spikes and alarm excursions stay visible. Never more than
+        max_points indexes are returned, which should be at least 4.
+        """
+        if max_points is not None and max_points < 4:
+            raise ValueError(f"Can not downsample to {max_points} points. Should be at least 4.")
+
+        total = len(values)
+        if max_points is None or total <= max_points:
+            return list(range(total))
+
+        values = numpy.asarray(values, dtype=float)
+        inner = numpy.arange(1, total - 1)
+        buckets = inner * ((max_points - 2) // 2) // (total - 1)
+
+        # Sort on bucket and then on value. The first item of every bucket is the lowest value, the last the highest
+        order = numpy.lexsort((values[inner], buckets))
+        sorted_buckets = buckets[order]
+        first = numpy.flatnonzero(numpy.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+        last = numpy.r_[first[1:], len(order)] - 1
+
+        return numpy.unique(numpy.r_[0, inner[order[first]], inner[order[last]], total - 1]).tolist()
+
     @staticmethod
     def clean_log_line(logline):
         # Some regex replacement to keep passwords/tokens out off the logging
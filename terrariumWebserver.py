@@ -6,6 +6,7 @@ logger = terrariumLogging.logging.getLogger(__name__)
 import gettext
 import threading
 import json
+import time
 import datetime
 import functools
 import re
@@ -33,10 +34,11 @@ BaseRequest.MEMFILE_MAX = 5 * 1024 * 1024
 
 from bottle.ext.websocket import GeventWebSocketServer
 from bottle.ext.websocket import websocket
-from queue import Queue
+from collections import deque
 
 from terrariumUtils import terrariumUtils
-from terrariumAPI import terrariumAPI
+from terrariumAPI import terrariumAPI, api_cache
+from terrariumMetrics import metrics
 
 
 class terrariumWebserver(object):
@@ -110,6 +112,13 @@ class terrariumWebserver(object):
                     response.set_cookie("no-cache", "1", secret=None, **{"max_age": 90, "path": "/"})
                     response.set_header("Cache-Control", "no-cache")
 
+                    result = func(*a, **ka)
+                    # Changes can affect all the cached API responses. Routes like the bulk history only read data
+                    if not request.route.config.get("read_only", False):
+                        api_cache.clear()
+
+                    return result
+
                 return func(*a, **ka)
 
             return wrapper
@@ -272,6 +281,9 @@ class terrariumWebserver(object):
         # Websocket connection
         self.bottle.route("/live/", callback=self.websocket.connect, apply=websocket, name="websocket_connect")
 
+        # Prometheus metrics
+        self.bottle.route("/metrics", method="GET", callback=self.__metrics, apply=self.authenticate(), name="metrics")
+
         # Login url
         self.bottle.route("/login/", method="GET", callback=self.__login, apply=self.authenticate(True), name="login")
 
@@ -329,6 +341,10 @@ class terrariumWebserver(object):
 
         return url
 
+    def __metrics(self):
+        response.content_type = metrics.CONTENT_TYPE
+        return metrics.export()
+
     def __login(self):
         response.set_cookie("auth", request.auth, secret=self.cookie_secret, **{"max_age": 3600, "path": "/"})
         if request.is_ajax:
@@ -346,6 +362,15 @@ class terrariumWebserver(object):
     def websocket_message(self, message_type, message_data):
         self.websocket.send_message({"type": message_type, "data": message_data})
 
+    def websocket_update(self, message_type, message_data):
+        self.websocket.update(message_type, message_data)
+
+    def websocket_flush(self):
+        self.websocket.flush()
+
+    def websocket_remove(self, message_type, item_id):
+        self.websocket.remove(message_type, item_id)
+
     def start(self):
         # Start the webserver
         logger.info(f'Running webserver at {self.engine.settings["host"]}:{self.engine.settings["port"]}')
@@ -363,37 +388,169 @@ class terrariumWebserver(object):
         )
 
 
+class terrariumWebsocketClient(object):
+    """
+    Bounded message queue of a single websocket client. The messages are already serialized, so all the clients share the same data.
+
+    When the queue is full, the oldest message with the same topic is dropped, as the new message replaces it. Else the oldest
+    message is dropped. A client that did not read any message for a while is stalled, and will be disconnected.
+
+    A client can subscribe to topics, with an optional list of ids per topic. Without subscriptions it gets all the messages.
+
+    A delta client gets the sensor and relay updates coalesced in a single message per engine round. When a message
+    is dropped or a round is missed, the client needs a resync, and will get a full snapshot with the next round.
+    """
+
+    __MAX_MESSAGES = 100
+    __STALLED_TIMEOUT = 30
+
+    def __init__(self, socket, authenticated=False):
+        self.socket = socket
+        self.authenticated = authenticated
+        self.subscriptions = None
+        self.delta = False
+        self.delta_round = None
+        self.resync = False
+        self.closed = False
+        self.__lock = threading.Lock()
+        self.__ready = threading.Event()
+        self.__messages = deque()
+        self.__last_read = time.time()
+
+    def qsize(self):
+        return len(self.__messages)
+
+    def subscribe(self, subscriptions):
+        """
+        Subscribe to a list of topics, or to a dict with a list of ids per topic. An empty or missing list of ids is all ids.
+        None will subscribe to all the topics.
+        """
+        if subscriptions is None:
+            self.subscriptions = None
+            return
+
+        if isinstance(subscriptions, list):
+            subscriptions = {topic: None for topic in subscriptions}
+
+        self.subscriptions = {
+            str(topic): set(str(topic_id) for topic_id in ids) if isinstance(ids, list) and len(ids) > 0 else None
+            for topic, ids in subscriptions.items()
+        }
+
+    def subscribed(self, message_type, message_id=None):
+        if self.subscriptions is None:
+            return True
+
+        if message_type not in self.subscriptions:
+            return False
+
+        # Messages without an id, like system stats, are not filtered on id
+        ids = self.subscriptions[message_type]
+        return ids is None or message_id is None or str(message_id) in ids
+
+    def put(self, topic, data):
+        with self.__lock:
+            if self.closed:
+                return False
+
+            if len(self.__messages) >= terrariumWebsocketClient.__MAX_MESSAGES:
+                if time.time() - self.__last_read > terrariumWebsocketClient.__STALLED_TIMEOUT:
+                    self.closed = True
+                    metrics.inc("terrariumpi_websocket_disconnects_total")
+                    self.__messages.clear()
+                else:
+                    for index, (queued_topic, _) in enumerate(self.__messages):
+                        if queued_topic == topic:
+                            del self.__messages[index]
+                            break
+                    else:
+                        self.__messages.popleft()
+
+                    self.resync = True
+                    metrics.inc("terrariumpi_websocket_dropped_messages_total")
+
+            if not self.closed:
+                self.__messages.append((topic, data))
+
+        self.__ready.set()
+        return not self.closed
+
+    def get(self):
+        # Wait for the next message. Returns None when the client is closed
+        while True:
+            with self.__lock:
+                if self.closed:
+                    return None
+
+                if len(self.__messages) > 0:
+                    self.__last_read = time.time()
+                    return self.__messages.popleft()[1]
+
+                self.__ready.clear()
+
+            self.__ready.wait()
+
+    def close(self):
+        with self.__lock:
+            self.closed = True
+
+        self.__ready.set()
+        # This will also stop a listener that is waiting on a stalled socket
+        try:
+            self.socket.close()
+        except Exception as ex:
+            logger.debug(f"Websocket {self.socket} could not be closed... {ex}")
+
+
 class terrariumWebsocket(object):
+    # Message types that are coalesced per engine round for the delta clients
+    __COALESCED = ("sensor", "relay")
+
     def __init__(self, terrariumWebserver):
         self.webserver = terrariumWebserver
         self.clients = []
 
+        # The last state that is send to the delta clients, and the updates of the current round
+        self.__lock = threading.Lock()
+        self.__snapshot = {message_type: {} for message_type in terrariumWebsocket.__COALESCED}
+        self.__updates = {message_type: {} for message_type in terrariumWebsocket.__COALESCED}
+        self.__round = 0
+
+        metrics.gauge("terrariumpi_websocket_clients", lambda: len(self.clients))
+        metrics.gauge("terrariumpi_websocket_queue_depth", lambda: sum(client.qsize() for client in self.clients))
+        metrics.gauge(
+            "terrariumpi_websocket_queue_depth_max", lambda: max([client.qsize() for client in self.clients], default=0)
+        )
+
     def connect(self, socket):
-        def listen_for_messages(messages, socket):
+        def listen_for_messages(client, socket):
             try:
-                self.clients.remove(messages)
+                self.clients.remove(client)
             except Exception as ex:
-                logger.debug(f"Client {messages} was not on the client list when started: {ex}")
+                logger.debug(f"Client {client} was not on the client list when started: {ex}")
 
-            self.clients.append(messages)
+            self.clients.append(client)
             logger.debug(f"Got a new websocket connection from {socket}")
 
             while True:
-                message = messages.get()
+                message = client.get()
                 try:
-                    socket.send(json.dumps(message))
-                    messages.task_done()
+                    if message is None:
+                        raise Exception("Client is closed or could not keep up with the messages")
+
+                    socket.send(message)
                 except Exception as ex:
                     # Socket connection is lost/closed, stop looping....
                     logger.debug(f"Disconnected {socket}. Stop listening and remove queue... {ex}")
                     try:
-                        self.clients.remove(messages)
+                        self.clients.remove(client)
                     except Exception as ex:
                         logger.debug(f"Disconnected {socket} is not in the clients queue... {ex}")
 
+                    client.close()
                     break
 
-        messages = Queue()
+        client = terrariumWebsocketClient(socket)
         authenticated = False
 
         # First try (existing) cookie login
@@ -410,8 +567,10 @@ class terrariumWebsocket(object):
             except Exception as ex:
                 # Closed websocket connection.
                 logger.debug(f"Websocket error receiving messages: {ex}")
+                # Stop the message listener as well
+                client.close()
                 try:
-                    self.clients.remove(messages)
+                    self.clients.remove(client)
                 except Exception as ex:
                     logger.debug(f"Clashed client was not in the list of clients {ex}")
 
@@ -438,15 +597,28 @@ class terrariumWebsocket(object):
                                     f"Invalid auth data. Either wrong base64 or strange auth. We can ignore this.: {ex}"
                                 )
 
-                    if not messages in self.clients:
-                        messages.authenticated = authenticated
-                        logger.debug(f"Starting authenticated socket? {messages.authenticated}")
+                    if "subscribe" in message:
+                        try:
+                            client.subscribe(message["subscribe"])
+                            logger.debug(f"Websocket client {socket} is subscribed to {client.subscriptions}")
+                        except Exception as ex:
+                            logger.debug(f"Invalid websocket subscriptions {message['subscribe']}. We can ignore this: {ex}")
+
+                    if "delta" in message:
+                        client.delta = message["delta"] is True
+                        if client.delta:
+                            # Start with a full snapshot, the next rounds will only send the changes
+                            self.__send_snapshot(client)
 
-                        threading.Thread(target=listen_for_messages, args=(messages, socket)).start()
+                    if not client in self.clients:
+                        client.authenticated = authenticated
+                        logger.debug(f"Starting authenticated socket? {client.authenticated}")
+
+                        threading.Thread(target=listen_for_messages, args=(client, socket)).start()
                         #for door in self.webserver.engine.load_doors():
-                        #    self.send_message({"type": "button", "data": door}, messages)
+                        #    self.send_message({"type": "button", "data": door}, client)
                     else:
-                        self.clients[self.clients.index(messages)].authenticated = authenticated
+                        self.clients[self.clients.index(client)].authenticated = authenticated
 
                     if self.webserver.engine.update_available:
                         self.send_message(
@@ -461,39 +633,175 @@ class terrariumWebsocket(object):
                                     + "</a>",
                                 },
                             },
-                            messages,
+                            client,
                         )
 
                 elif "load_dashboard" == message["type"]:
-                    self.send_message({"type": "systemstats", "data": self.webserver.engine.system_stats()}, messages)
+                    self.send_message({"type": "systemstats", "data": self.webserver.engine.system_stats()}, client)
                     self.send_message(
                         {"type": "power_usage_water_flow", "data": self.webserver.engine.get_power_usage_water_flow},
-                        messages,
+                        client,
                     )
 
                     for sensor_type, avg_data in self.webserver.engine.sensor_averages.items():
                         avg_data["id"] = sensor_type
-                        self.send_message({"type": "sensor", "data": avg_data}, messages)
-
-    def send_message(self, message, queue=None):
-        # Get all the connected websockets (get a copy of the list, as we could delete entries and change the list length during the loop)
-        clients = self.clients
-        # Loop over all the clients
-        for client in clients:
-            if queue is None or queue == client:
-                if "logline" == message["type"] and not client.authenticated:
-                    # Clean the logline message. Keep date and type for web indicators
-                    message["data"] = message["data"][0:36].strip()
-
-                client.put(message)
-            # If more then 50 messages in queue, looks like connection is gone and remove the queue from the list
-            if client.qsize() > 50:
-                logger.debug(
-                    f"Lost connection.... should not happen anymore. {len(self.clients)} - {client.qsize()} - {client}"
-                )
+                        self.send_message({"type": "sensor", "data": avg_data}, client)
+
+    def __filter(self, data, client):
+        if client.subscriptions is None:
+            return data
+
+        return {
+            message_type: [item for item in items if client.subscribed(message_type, item["id"])]
+            for message_type, items in data.items()
+        }
+
+    def __snapshot_data(self):
+        return {message_type: list(items.values()) for message_type, items in self.__snapshot.items()}
+
+    def __send_snapshot(self, client):
+        with self.__lock:
+            client.resync = False
+            client.delta_round = self.__round
+            data = self.__filter(self.__snapshot_data(), client)
+            client.put(("snapshot", None), json.dumps({"type": "snapshot", "data": data}))
+
+    def update(self, message_type, data):
+        """
+        Coalesce a sensor or relay update. The clients without delta support get the message directly. The delta clients
+        will get all the changes of the round in one message with the next flush.
+        """
+        with self.__lock:
+            self.__updates[message_type][data["id"]] = {**self.__updates[message_type].get(data["id"], {}), **data}
+
+        self.send_message({"type": message_type, "data": data}, coalesced=True)
+
+    def flush(self):
+        """
+        Send the changed fields of all the updates of this round to the delta clients. An updated item without changes
+        is still send with only its id, so the clients know it is up to date.
+        """
+        with self.__lock:
+            delta = {message_type: [] for message_type in terrariumWebsocket.__COALESCED}
+            for message_type, updates in self.__updates.items():
+                for item_id, data in updates.items():
+                    old_data = self.__snapshot[message_type].get(item_id, {})
+                    delta[message_type].append(
+                        {field: value for field, value in data.items() if field == "id" or old_data.get(field) != value}
+                    )
+                    self.__snapshot[message_type][item_id] = {**old_data, **data}
+
+                updates.clear()
+
+            if sum(len(items) for items in delta.values()) == 0:
+                return
+
+            self.__round += 1
+
+            # Serialize the messages only once for all the delta clients without subscriptions
+            messages = {"delta": delta, "snapshot": None}
+            serialized = {}
+            for websocket_client in list(self.clients):
+                if not websocket_client.delta:
+                    continue
+
+                # A client that lost messages or missed a round needs a full snapshot, the changes are not enough
+                resync = websocket_client.resync or websocket_client.delta_round != self.__round - 1
+                message_type = "snapshot" if resync else "delta"
+                websocket_client.resync = False
+                websocket_client.delta_round = self.__round
+                if "snapshot" == message_type and messages["snapshot"] is None:
+                    messages["snapshot"] = self.__snapshot_data()
+
+                if websocket_client.subscriptions is not None:
+                    client_data = self.__filter(messages[message_type], websocket_client)
+                    if sum(len(items) for items in client_data.values()) == 0:
+                        continue
+
+                    client_data = json.dumps({"type": message_type, "data": client_data})
+                else:
+                    if message_type not in serialized:
+                        serialized[message_type] = json.dumps({"type": message_type, "data": messages[message_type]})
+
+                    client_data = serialized[message_type]
+
+                if not websocket_client.put((message_type, None), client_data):
+                    logger.debug(f"Websocket client {websocket_client} is stalled. Disconnecting...")
+                    websocket_client.close()
+                    try:
+                        self.clients.remove(websocket_client)
+                    except Exception as ex:
+                        logger.debug(f"Client {websocket_client} was not on the client list anymore: {ex}")
+
+        logger.debug(f"Websocket delta with {sum(len(items) for items in delta.values())} updates is send")
+
+    def remove(self, message_type, item_id):
+        """
+        Forget a deleted sensor or relay, so the snapshots for new and resynced clients do not show it anymore
+        """
+        if message_type not in terrariumWebsocket.__COALESCED:
+            return
+
+        with self.__lock:
+            self.__snapshot[message_type].pop(item_id, None)
+            self.__updates[message_type].pop(item_id, None)
+
+    def send_message(self, message, client=None, coalesced=False):
+        # A newer message with the same topic replaces the older one when a client queue is full
+        topic = (message["type"], message["data"].get("id") if isinstance(message["data"], dict) else None)
+
+        if (
+            client is None
+            and not coalesced
+            and message["type"] in terrariumWebsocket.__COALESCED
+            and topic[1] is not None
+        ):
+            # Direct updates, like switching a relay, are send to all clients. Keep the delta snapshot in sync
+            with self.__lock:
+                self.__snapshot[message["type"]][topic[1]] = {
+                    **self.__snapshot[message["type"]].get(topic[1], {}),
+                    **message["data"],
+                }
+
+        # Serialize the message only once, when the first client is interested. All the clients share the same data
+        data = None
+        public_data = None
+
+        # Loop over a copy of the connected clients, as clients can be removed during the loop
+        for websocket_client in list(self.clients):
+            if client is not None and client != websocket_client:
+                continue
+
+            # Only route broadcasts to the clients that are subscribed. Direct messages are always send
+            if client is None and not websocket_client.subscribed(*topic):
+                continue
+
+            # Coalesced updates are send to the delta clients with the next flush
+            if coalesced and websocket_client.delta:
+                continue
+
+            if data is None:
+                data = json.dumps(message)
+
+            client_data = data
+            if "logline" == message["type"] and not websocket_client.authenticated:
+                if public_data is None:
+                    # Clean the logline message. Keep date and type of every line for web indicators
+                    public_data = json.dumps(
+                        {
+                            "type": message["type"],
+                            "data": "\n".join(line[0:36].strip() for line in message["data"].split("\n")),
+                        }
+                    )
+
+                client_data = public_data
+
+            if not websocket_client.put(topic, client_data):
+                logger.debug(f"Websocket client {websocket_client} is stalled. Disconnecting...")
+                websocket_client.close()
                 try:
-                    self.clients.remove(client)
+                    self.clients.remove(websocket_client)
                 except Exception as ex:
-                    logger.debug(f"Client {client} was not on the client list anymore: {ex}")
+                    logger.debug(f"Client {websocket_client} was not on the client list anymore: {ex}")
 
-        logger.debug(f"Websocket message {message} is send to {len(self.clients)} clients")
+        logger.debug(f"Websocket message {message['type']} is send to {len(self.clients)} clients")